@@ -1,29 +1,33 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import json
 import os
+import sys
 from datetime import datetime
-import hashlib
+
+from result_store import SimulationRecord, create_result_store, new_simulation_id
+
+# Shared helpers live next to the backend API
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+from line_webhook import LineWebhook, WebhookError
+from market_data import get_market_table, market_data
+from result_cache import ResultCache, canonical_key
 
 app = Flask(__name__)
 CORS(app)
 
-# In-memory storage for simulation results (in production, use a database)
-simulation_results = {}
+# Bounded storage for simulation results (RESULT_STORE=sqlite shares it across workers)
+simulation_results = create_result_store()
+
+# Cache of calculated results keyed by the normalized input
+calculation_cache = ResultCache()
+market_data.add_listener(calculation_cache.clear)
 
 # Configuration
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', '')
 
-# Region data
-REGIONS = {
-    'tokyo': {'name': '東京都', 'price': 8500, 'occupancy': 75},
-    'osaka': {'name': '大阪府', 'price': 6500, 'occupancy': 70},
-    'kyoto': {'name': '京都府', 'price': 7000, 'occupancy': 68},
-    'kanagawa': {'name': '神奈川県', 'price': 7500, 'occupancy': 72},
-    'aichi': {'name': '愛知県', 'price': 5500, 'occupancy': 65},
-    'fukuoka': {'name': '福岡県', 'price': 4500, 'occupancy': 62}
-}
+# Verifies the signature over the raw body and parses it once (shared with the backend API)
+line_webhook_receiver = LineWebhook(LINE_CHANNEL_SECRET)
 
 MINPAKU_LAWS = {
     'shinpo': {'name': '民泊新法対応', 'days': 180},
@@ -36,27 +40,54 @@ OPERATION_TYPES = {
     'purchase': {'name': '購入', 'subtitle': '物件購入して民泊運営'}
 }
 
+def revenue_row(rates, max_days):
+    """(region name, daily price, occupancy, operating days, annual revenue) for one region and day limit"""
+    daily_price = int(rates.daily_rate) if rates else 0
+    occupancy_rate = rates.occupancy if rates else 0
+    actual_operating_days = int(min(max_days, 365) * occupancy_rate)
+    return rates.region if rates else '', daily_price, occupancy_rate, actual_operating_days, daily_price * actual_operating_days
+
+def build_revenue_table(market):
+    """Precompute revenue rows for every region key (name or alias) and minpaku law on the form"""
+    return {
+        (key, law): revenue_row(market.get(key), law_data['days'])
+        for key in list(market.regions) + list(market.aliases)
+        for law, law_data in MINPAKU_LAWS.items()
+    }
+
+# Built at startup and rebuilt whenever the shared market data is reloaded
+revenue_table = {'market': None, 'rows': {}}
+
+def current_revenue_table():
+    market = get_market_table()
+    if revenue_table['market'] is not market:
+        revenue_table['rows'] = build_revenue_table(market)
+        revenue_table['market'] = market
+    return market, revenue_table['rows']
+
+current_revenue_table()
+
+def revenue_coefficients(region, minpaku_law):
+    """Look up the precomputed revenue row, computing it directly for keys not on the form"""
+    market, rows = current_revenue_table()
+    row = rows.get((region, minpaku_law))
+    if row is None:
+        row = revenue_row(market.get(region), MINPAKU_LAWS.get(minpaku_law, {}).get('days', 365))
+    return row
+
 def calculate_simulation_results(data):
     """Calculate detailed simulation results"""
     try:
-        # Get region data
-        region_data = REGIONS.get(data['region'], {})
-        daily_price = region_data.get('price', 0)
-        occupancy_rate = region_data.get('occupancy', 0) / 100
-        
-        # Get minpaku law data
+        # Revenue depends only on the region and minpaku law (shared market data, keyed by e.g. 'tokyo')
+        region_name, daily_price, occupancy_rate, actual_operating_days, annual_revenue = revenue_coefficients(
+            data['region'], data['minpakuLaw']
+        )
         law_data = MINPAKU_LAWS.get(data['minpakuLaw'], {})
-        max_days = law_data.get('days', 365)
         
         # Calculate basic metrics
         area = int(data.get('customArea') or data.get('area', 0))
         capacity = int(data.get('capacity', 1))
         
-        # Annual revenue calculation
-        annual_operating_days = min(max_days, 365)
-        actual_operating_days = int(annual_operating_days * occupancy_rate)
-        annual_revenue = daily_price * actual_operating_days
-        
         # Cost calculations
         renovation_cost = int(data.get('renovationCost', 0)) * 10000  # Convert to yen
         
@@ -88,7 +119,7 @@ def calculate_simulation_results(data):
         monthly_profit = annual_profit / 12
         
         return {
-            'region': region_data.get('name', ''),
+            'region': region_name,
             'operationType': OPERATION_TYPES.get(data['operationType'], {}).get('name', ''),
             'propertyType': data.get('propertyType', ''),
             'area': area,
@@ -114,6 +145,40 @@ def calculate_simulation_results(data):
         print(f"Calculation error: {e}")
         return None
 
+def normalize_simulation_input(data):
+    """Normalize form input so equivalent submissions share a cache key"""
+    def to_int(value):
+        return int(value) if value else 0
+
+    return {
+        'region': data['region'],
+        'minpakuLaw': data['minpakuLaw'],
+        'operationType': data['operationType'],
+        'propertyType': data.get('propertyType', ''),
+        'area': to_int(data.get('customArea') or data.get('area', 0)),
+        'capacity': int(data.get('capacity', 1)),
+        'renovationCost': to_int(data.get('renovationCost', 0)),
+        'monthlyRent': to_int(data.get('monthlyRent', 0)),
+        'purchasePrice': to_int(data.get('purchasePrice', 0)),
+        'initialCosts': {k: to_int(v) for k, v in (data.get('initialCosts') or {}).items()}
+    }
+
+def calculate_cached(data):
+    """Calculate simulation results, reusing cached results for identical input"""
+    try:
+        key = canonical_key(normalize_simulation_input(data))
+    except Exception:
+        return calculate_simulation_results(data)
+
+    results = calculation_cache.get(key)
+    if results is None:
+        results = calculate_simulation_results(data)
+        if results is None:
+            return None
+        calculation_cache.put(key, results)
+
+    return dict(results, timestamp=datetime.now().isoformat())
+
 def format_result_message(results):
     """Format simulation results for LINE message"""
     if not results:
@@ -155,21 +220,20 @@ def save_simulation():
     try:
         data = request.json
         
-        # Generate unique ID for this simulation
-        simulation_id = hashlib.md5(
-            (str(data) + str(datetime.now())).encode()
-        ).hexdigest()[:8]
+        # Time-ordered ID, unique across workers (no hashing of the payload)
+        simulation_id = new_simulation_id()
         
         # Calculate results
-        results = calculate_simulation_results(data)
+        results = calculate_cached(data)
         
         if results:
-            # Store results with ID
-            simulation_results[simulation_id] = results
+            # Store a compact record with ID (expanded to the result dict on read)
+            record = SimulationRecord.from_results(results)
+            simulation_results.put(simulation_id, record)
             
             # Also store with a simple key for LINE bot access
             # In a real app, you'd associate this with the user's LINE ID
-            simulation_results['latest'] = results
+            simulation_results.put('latest', record)
             
             return jsonify({
                 'success': True,
@@ -193,8 +257,9 @@ def save_simulation():
 def line_webhook():
     """Handle LINE webhook events"""
     try:
-        body = request.get_data(as_text=True)
-        events = json.loads(body).get('events', [])
+        line_webhook_receiver.check_length(request.content_length)
+        body = request.stream.read(line_webhook_receiver.max_bytes + 1)
+        events = line_webhook_receiver.parse(body, request.headers.get('X-Line-Signature'))
         
         for event in events:
             if event['type'] == 'message' and event['message']['type'] == 'text':
@@ -203,10 +268,10 @@ def line_webhook():
                 
                 if user_message == '結果':
                     # Get latest simulation results
-                    latest_results = simulation_results.get('latest')
+                    latest_record = simulation_results.get('latest')
                     
-                    if latest_results:
-                        response_message = format_result_message(latest_results)
+                    if latest_record:
+                        response_message = format_result_message(latest_record.to_results())
                     else:
                         response_message = """まだシミュレーション結果がありません。
 
@@ -239,6 +304,8 @@ def line_webhook():
         
         return jsonify({'status': 'success'})
         
+    except WebhookError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), e.status
     except Exception as e:
         print(f"Webhook error: {e}")
         return jsonify({'status': 'error'}), 500
@@ -276,12 +343,12 @@ def send_line_reply(reply_token, message):
 @app.route('/api/results/<simulation_id>', methods=['GET'])
 def get_simulation_results(simulation_id):
     """Get simulation results by ID"""
-    results = simulation_results.get(simulation_id)
+    record = simulation_results.get(simulation_id)
     
-    if results:
+    if record:
         return jsonify({
             'success': True,
-            'results': results
+            'results': record.to_results()
         })
     else:
         return jsonify({
@@ -295,7 +362,9 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'stored_results': len(simulation_results)
+        'stored_results': simulation_results.count(),
+        'result_store': simulation_results.stats(),
+        'calculation_cache': calculation_cache.stats()
     })
 
 @app.route('/', methods=['GET'])
@@ -0,0 +1,223 @@
+"""非同期（ASGI）版のAPIサーバー（main.pyのFlaskアプリもそのまま使える）
+
+    pip install -r requirements-asgi.txt
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker --workers 2
+
+待ち時間の長いルート（計算・保存・最新結果・履歴・LINE Webhook）はイベントループ上で処理する。
+SQLiteの処理はスレッドプールで実行し、LINEへの送信はhttpxで非同期に行うため、
+処理中のリクエストがOSスレッドを占有しない。
+それ以外のルート（一括計算・感度分析・予測・エクスポート・集計・/metrics・静的ファイル）は
+Flaskアプリにそのまま渡す。
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial, wraps
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Mount, Route
+
+import main
+from ingest import INGEST_SYNC_DEFAULT, BufferFull
+from line_dispatch_async import AsyncLineDispatcher
+from line_events import text_events
+from line_webhook import WebhookError
+from metrics import timed
+from simulation import ScenarioError
+
+# DB処理を実行するスレッド数
+ASGI_DB_THREADS = int(os.environ.get('ASGI_DB_THREADS', '32'))
+# LINEへの同時送信数
+ASGI_LINE_WORKERS = int(os.environ.get('ASGI_LINE_WORKERS', '64'))
+# Flaskに渡すルートを処理するスレッド数
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '10'))
+# 終了時に送信待ちのLINEメッセージを待つ秒数
+SHUTDOWN_TIMEOUT = 10
+
+db_executor = ThreadPoolExecutor(ASGI_DB_THREADS, thread_name_prefix='asgi-db')
+line_dispatcher = AsyncLineDispatcher(main.LINE_CHANNEL_ACCESS_TOKEN, workers=ASGI_LINE_WORKERS)
+main.line_dispatchers.append(line_dispatcher)
+
+
+async def run_blocking(func, *args):
+    """ブロックする処理（SQLite・モンテカルロ）をスレッドプールで実行"""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, partial(func, *args))
+
+
+def instrumented(route):
+    """Flask側と同じルート別の計測値を記録"""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            started = time.perf_counter()
+            main.requests_in_flight.inc(route)
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            finally:
+                main.requests_in_flight.dec(route)
+                main.request_seconds.observe(time.perf_counter() - started, route, request.method, status)
+        return wrapper
+    return decorator
+
+
+async def read_webhook_body(request, receiver):
+    """本文を上限+1バイトまで読む（Content-Lengthが上限を超えていれば読まずに拒否）"""
+    length = request.headers.get('content-length')
+    receiver.check_length(int(length) if length and length.isdigit() else None)
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > receiver.max_bytes:
+            break
+    return b''.join(chunks)
+
+
+async def read_json(request):
+    body = await request.body()
+    with timed('json_parse'):
+        return json.loads(body)
+
+
+@instrumented('/api/simulation/calculate')
+async def calculate_simulation(request):
+    """シミュレーション計算API"""
+    try:
+        data = await read_json(request)
+        if data.get('mode') == 'montecarlo':
+            result = await run_blocking(main.run_calculation, data)
+        else:
+            result = main.run_calculation(data)
+        return JSONResponse(result)
+
+    except ScenarioError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@instrumented('/api/simulation/save')
+async def save_simulation(request):
+    """シミュレーション結果を保存（コミットはイベントループを塞がずに待つ）"""
+    try:
+        data = await read_json(request)
+        params = main.save_params(data)
+
+        if not bool(data.get('sync', INGEST_SYNC_DEFAULT)):
+            main.simulation_writer.submit(params, wait=False)
+            return JSONResponse({'success': True, 'queued': True}, status_code=202)
+
+        simulation_id = await main.simulation_writer.submit_async(params)
+        return JSONResponse({'success': True, 'simulationId': simulation_id})
+
+    except BufferFull as e:
+        return JSONResponse({'error': str(e)}, status_code=503)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@instrumented('/api/simulation/latest/<user_id>')
+async def get_latest_simulation(request):
+    """最新のシミュレーション結果を取得"""
+    try:
+        result = await run_blocking(main.fetch_latest, request.path_params['user_id'])
+        if result:
+            return JSONResponse(result)
+        return JSONResponse({'error': 'No simulation found'}, status_code=404)
+
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@instrumented('/api/simulation/history/<user_id>')
+async def get_simulation_history(request):
+    """シミュレーション履歴を取得（cursorで次のページ）"""
+    try:
+        page = await run_blocking(
+            main.history_page,
+            request.path_params['user_id'],
+            request.query_params.get('limit'),
+            request.query_params.get('cursor')
+        )
+        return JSONResponse(page)
+
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@instrumented('/api/simulation/ingest/stats')
+async def ingest_stats(request):
+    return JSONResponse(main.simulation_writer.snapshot())
+
+
+@instrumented('/api/line/webhook')
+async def line_webhook(request):
+    """LINE Webhook エンドポイント"""
+    try:
+        receiver = main.line_webhook_receiver
+        body = await read_webhook_body(request, receiver)
+        events = receiver.parse(body, request.headers.get('X-Line-Signature'))
+        # 途中で失敗したら、処理済みにしたイベントIDを戻して再送を受け付ける
+        with main.event_deduplicator.claim() as claimed:
+            messages = list(text_events(events, claimed))
+            if not messages:
+                return PlainTextResponse('OK')
+
+            outbox = await run_blocking(main.build_replies, messages)
+            for user_id, user_messages in outbox.pushes():
+                line_dispatcher.push(user_id, user_messages)
+
+        return PlainTextResponse('OK')
+
+    except WebhookError as e:
+        return PlainTextResponse(str(e), status_code=e.status)
+    except Exception as e:
+        print(f"Webhook error: {e}")
+        return PlainTextResponse('Error', status_code=500)
+
+
+async def line_webhook_verify(request):
+    """LINE Webhook 検証用エンドポイント"""
+    return PlainTextResponse('LINE Webhook is working!')
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # 終了時は送信待ちのメッセージを（一定時間まで）送り切る
+    try:
+        await asyncio.wait_for(line_dispatcher.join(), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    await line_dispatcher.close()
+    db_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/api/simulation/calculate', calculate_simulation, methods=['POST']),
+        Route('/api/simulation/save', save_simulation, methods=['POST']),
+        Route('/api/simulation/latest/{user_id}', get_latest_simulation, methods=['GET']),
+        Route('/api/simulation/history/{user_id}', get_simulation_history, methods=['GET']),
+        Route('/api/simulation/ingest/stats', ingest_stats, methods=['GET']),
+        Route('/api/line/webhook', line_webhook, methods=['POST']),
+        Route('/api/line/webhook', line_webhook_verify, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(main.app, workers=ASGI_WSGI_THREADS))
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
@@ -0,0 +1,430 @@
+"""計算処理のマイクロベンチマークとAPIの負荷試験
+
+    python benchmark.py micro --output micro.json
+    python benchmark.py load --duration 10 --concurrency 16 --output load.json
+    python benchmark.py all --output current.json --baseline baseline.json
+
+load はLINE APIスタブ（line_stub.py）を起動し、一時DBでgunicornを立ち上げて計測する。
+--url を指定すると起動済みのサーバーに対して計測する（その場合RSSは計測しない）。
+--baseline を指定すると結果を比較し、許容幅を超えて悪化した項目があれば終了コード1で終わる。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+import line_stub
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BACKEND_DIR)
+
+BENCH_CHANNEL_SECRET = 'benchmark-channel-secret'
+BENCH_USERS = 50
+STARTUP_TIMEOUT = 30
+
+# 比較する指標と、値が大きいほど良いか
+COMPARED_METRICS = {
+    'p50Ms': False,
+    'p95Ms': False,
+    'p99Ms': False,
+    'throughput': True,
+    'opsPerSecond': True
+}
+
+SAMPLE_FORM = {
+    'region': 'tokyo',
+    'minpakuLaw': 'shinpo',
+    'operationType': 'rental',
+    'propertyType': 'マンション',
+    'area': 40,
+    'capacity': 4,
+    'renovationCost': 200,
+    'monthlyRent': 150000,
+    'initialCosts': {'deposit': 300000, 'furniture': 500000}
+}
+
+SAMPLE_SCENARIO = {
+    'region': '東京都',
+    'operationType': '転貸',
+    'propertyType': 'マンション',
+    'area': 40,
+    'capacity': 4,
+    'minpakuLaw': '民泊新法対応（180日制限あり）',
+    'monthlyRent': 150000,
+    'renovationCost': 2000000,
+    'initialCost': 800000
+}
+
+
+def percentile(sorted_values, q):
+    """ソート済みの値の分位点（最近接順位法）"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50Ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p95Ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'p99Ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'maxMs': round(latencies[-1] * 1000, 3) if latencies else None
+    }
+
+
+# --- マイクロベンチマーク ---
+
+def time_function(func, iterations, repeat=5):
+    """funcをiterations回ずつrepeat回実行し、1回あたりの時間を集計"""
+    func()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for _ in range(iterations):
+            call_started = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies)
+    result['opsPerSecond'] = round(len(latencies) / elapsed, 1)
+    return result
+
+
+def run_micro(iterations):
+    """app.pyとmain.pyの計算処理をプロセス内で計測"""
+    sys.path.insert(0, ROOT_DIR)
+    import app as form_app
+    import main
+
+    results = {}
+    results['calculate_simulation_results'] = time_function(
+        lambda: form_app.calculate_simulation_results(SAMPLE_FORM), iterations
+    )
+
+    # APIハンドラーをリクエストコンテキスト内で直接呼ぶ（キャッシュなし・キャッシュありの両方）
+    with main.app.test_request_context('/api/simulation/calculate', method='POST', json=SAMPLE_SCENARIO):
+        def uncached():
+            main.simulation_cache.clear()
+            main.calculate_simulation()
+
+        results['calculate_simulation'] = time_function(uncached, iterations)
+        results['calculate_simulation_cached'] = time_function(main.calculate_simulation, iterations)
+    return results
+
+
+# --- 負荷試験 ---
+
+def sign(body, secret=BENCH_CHANNEL_SECRET):
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def webhook_body(sequence, users=BENCH_USERS):
+    """「結果」を送ったテキストメッセージイベント1件のWebhook本文"""
+    event = {
+        'type': 'message',
+        'webhookEventId': f'bench-{os.getpid()}-{sequence}',
+        'source': {'type': 'user', 'userId': f'bench-user-{sequence % users}'},
+        'message': {'type': 'text', 'text': '結果'}
+    }
+    return json.dumps({'events': [event]}, ensure_ascii=False).encode('utf-8')
+
+
+def saved_simulation(sequence, users=BENCH_USERS):
+    return dict(
+        SAMPLE_SCENARIO,
+        userId=f'bench-user-{sequence % users}',
+        annualRevenue=3600000,
+        annualExpenses=2500000,
+        annualProfit=1100000,
+        roi=39.3,
+        recoveryPeriod=2.5
+    )
+
+
+def build_scenarios(secret):
+    """(名前, HTTPメソッド, パス, 連番からリクエスト引数を作る関数, 成功とみなすステータス)"""
+    def webhook(sequence):
+        body = webhook_body(sequence)
+        return {
+            'data': body,
+            'headers': {'Content-Type': 'application/json', 'X-Line-Signature': sign(body, secret)}
+        }
+
+    return [
+        ('calculate', 'POST', lambda n: '/api/simulation/calculate',
+         lambda n: {'json': SAMPLE_SCENARIO}, (200,)),
+        ('save', 'POST', lambda n: '/api/simulation/save',
+         lambda n: {'json': saved_simulation(n)}, (200,)),
+        ('latest', 'GET', lambda n: f'/api/simulation/latest/bench-user-{n % BENCH_USERS}',
+         lambda n: {}, (200,)),
+        ('webhook', 'POST', lambda n: '/api/line/webhook', webhook, (200,))
+    ]
+
+
+def run_scenario(base_url, scenario, concurrency, duration):
+    """concurrency本のスレッドでduration秒間リクエストを送り続ける"""
+    _, method, path, make_args, ok_statuses = scenario
+    latencies = []
+    errors = {}
+    counter = iter(range(10 ** 12))
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker():
+        session = requests.Session()
+        local_latencies = []
+        local_errors = {}
+        while time.monotonic() < deadline:
+            with lock:
+                sequence = next(counter)
+            started = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path(sequence), timeout=30, **make_args(sequence))
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            local_latencies.append(time.perf_counter() - started)
+            if status not in ok_statuses:
+                local_errors[str(status)] = local_errors.get(str(status), 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for key, count in local_errors.items():
+                errors[key] = errors.get(key, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies)
+    result['throughput'] = round(len(latencies) / elapsed, 1)
+    result['errors'] = errors
+    return result
+
+
+def process_tree_rss_kb(pid):
+    """プロセスと子プロセスのRSS合計（KB、/procがない環境ではNone）"""
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def wait_until_ready(base_url, process=None, timeout=STARTUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            if requests.get(base_url + '/api/line/webhook', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Server did not start within {timeout} seconds')
+
+
+def start_gunicorn(port, workers, threads, env):
+    gunicorn = shutil.which('gunicorn')
+    if gunicorn is None:
+        raise RuntimeError('gunicorn is not installed (pip install gunicorn, or use --url)')
+
+    # スキーマはgunicorn起動前に作成しておく
+    subprocess.run([sys.executable, '-c', 'from db import init_database; init_database()'],
+                   cwd=BACKEND_DIR, env=env, check=True)
+    return subprocess.Popen([
+        gunicorn, 'main:app',
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers),
+        '--threads', str(threads),
+        '--log-level', 'warning'
+    ], cwd=BACKEND_DIR, env=env)
+
+
+def run_load(args):
+    """スタブとgunicornを起動して各APIに負荷をかける（--url指定時は起動済みのサーバー）"""
+    stub = None
+    server = None
+    workdir = None
+    secret = args.channel_secret
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            stub = line_stub.serve(port=0, delay_ms=args.stub_delay_ms)
+            threading.Thread(target=stub.serve_forever, daemon=True).start()
+            workdir = tempfile.mkdtemp(prefix='minpaku-bench-')
+            env = dict(
+                os.environ,
+                DATABASE_PATH=os.path.join(workdir, 'simulations.db'),
+                LINE_DEAD_LETTER_PATH=os.path.join(workdir, 'line_dead_letter.ndjson'),
+                LINE_API_BASE=f'http://127.0.0.1:{stub.server_address[1]}',
+                LINE_CHANNEL_SECRET=secret,
+                LINE_CHANNEL_ACCESS_TOKEN='benchmark-token'
+            )
+            base_url = f'http://127.0.0.1:{args.port}'
+            server = start_gunicorn(args.port, args.workers, args.threads, env)
+        wait_until_ready(base_url, server)
+
+        # 最新結果の取得が404にならないよう、先に各ユーザー分を保存
+        session = requests.Session()
+        for sequence in range(BENCH_USERS):
+            session.post(base_url + '/api/simulation/save', json=saved_simulation(sequence), timeout=30)
+
+        rss_start = process_tree_rss_kb(server.pid) if server else None
+        results = {}
+        for scenario in build_scenarios(secret):
+            name = scenario[0]
+            if args.scenarios and name not in args.scenarios:
+                continue
+            results[name] = run_scenario(base_url, scenario, args.concurrency, args.duration)
+            print(f"load {name}: {results[name]['throughput']} req/s, p95 {results[name]['p95Ms']} ms",
+                  file=sys.stderr)
+        rss_end = process_tree_rss_kb(server.pid) if server else None
+
+        results['_server'] = {
+            'rssStartKb': rss_start,
+            'rssEndKb': rss_end,
+            'rssGrowthKb': rss_end - rss_start if rss_start is not None and rss_end is not None else None,
+            'stubReceived': stub.state.received if stub else None,
+            'stubMessages': stub.state.messages if stub else None
+        }
+        return results
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if stub is not None:
+            stub.shutdown()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+# --- ベースラインとの比較 ---
+
+def compare(current, baseline, tolerance):
+    """許容幅（割合）を超えて悪化した指標の一覧"""
+    regressions = []
+    for section in ('micro', 'load'):
+        for name, metrics in current.get(section, {}).items():
+            base_metrics = baseline.get(section, {}).get(name)
+            if not base_metrics or name.startswith('_'):
+                continue
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                value, base_value = metrics.get(metric), base_metrics.get(metric)
+                if not value or not base_value:
+                    continue
+                change = (value - base_value) / base_value
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append({
+                        'benchmark': f'{section}.{name}',
+                        'metric': metric,
+                        'baseline': base_value,
+                        'current': value,
+                        'change': round(change * 100, 1)
+                    })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='シミュレーションAPIのベンチマーク・負荷試験')
+    parser.add_argument('mode', choices=['micro', 'load', 'all'], nargs='?', default='all')
+    parser.add_argument('--iterations', type=int, default=2000, help='マイクロベンチマークの1セットの回数')
+    parser.add_argument('--duration', type=float, default=10, help='負荷試験の1シナリオの秒数')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--scenarios', nargs='*', help='calculate save latest webhook から選択')
+    parser.add_argument('--url', help='起動済みサーバーのURL（省略時はgunicornを起動）')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--stub-delay-ms', type=int, default=0, help='LINE APIスタブの応答遅延')
+    parser.add_argument('--channel-secret', default=os.environ.get('LINE_CHANNEL_SECRET', BENCH_CHANNEL_SECRET),
+                        help='Webhook署名に使うチャネルシークレット（--url指定時はサーバーと合わせる）')
+    parser.add_argument('--output', help='結果JSONの出力先（省略時は標準出力）')
+    parser.add_argument('--baseline', help='比較するベースラインの結果JSON')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='悪化とみなす変化の割合')
+    args = parser.parse_args(argv)
+
+    results = {
+        'createdAt': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'iterations': args.iterations,
+            'duration': args.duration,
+            'concurrency': args.concurrency,
+            'workers': args.workers,
+            'threads': args.threads
+        }
+    }
+    if args.mode in ('micro', 'all'):
+        results['micro'] = run_micro(args.iterations)
+    if args.mode in ('load', 'all'):
+        results['load'] = run_load(args)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            results['regressions'] = compare(results, json.load(f), args.tolerance)
+        for regression in results['regressions']:
+            print(f"REGRESSION {regression['benchmark']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']} ({regression['change']:+}%)", file=sys.stderr)
+        exit_code = 1 if results['regressions'] else 0
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,388 @@
+"""類似シミュレーション（保存済みの結果のうち条件が近いK件）の検索
+
+地域×民泊法×運営形態ごとに、面積・収容人数・家賃（購入の場合は購入価格）を座標とするKD木を持つ。
+内部ノードは配列で持ち、葉には座標（float32）とIDを型付き配列で格納する（座標とIDで1件20バイト、葉と内部ノードを含めて1件あたり約40バイト）。
+起動時にsimulationsテーブルから作成し、以降は保存のコミット時に追加する。
+他のワーカーが保存した行は、検索時（COMPARABLES_REFRESH_MS ごと）にIDの続きから読み込む。
+削除された行は索引に残るが、詳細を読むときに除外される。
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from heapq import heappush, heapreplace
+from itertools import compress
+
+from db import get_connection
+from market_data import get_market_table
+from simulation import SUBLEASE
+
+# 返す件数の既定値と上限
+COMPARABLES_K = int(os.environ.get('COMPARABLES_K', '10'))
+COMPARABLES_MAX_K = int(os.environ.get('COMPARABLES_MAX_K', '100'))
+# 他のワーカーが保存した行を確認する間隔
+COMPARABLES_REFRESH_MS = float(os.environ.get('COMPARABLES_REFRESH_MS', '1000'))
+# 起動時（create_app）に索引を作成するか（0なら初回の検索時）
+COMPARABLES_PRELOAD = os.environ.get('COMPARABLES_PRELOAD', '1') == '1'
+
+# 葉の件数がこれを超えたら分割する（すべて同じ座標の葉は分割しない）
+LEAF_SIZE = 64
+# テーブルから一度に読む行数
+LOAD_CHUNK_SIZE = 10000
+
+SELECT_INDEX_ROWS_SQL = '''
+    SELECT id, region, minpaku_law, operation_type, area, capacity, monthly_rent, purchase_price
+    FROM simulations
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+'''
+
+# 結果として返す列（user_id は返さない）
+COMPARABLE_COLUMNS = [
+    'id', 'created_at', 'region', 'operation_type', 'property_type', 'area', 'capacity',
+    'minpaku_law', 'monthly_rent', 'purchase_price', 'annual_profit', 'roi', 'recovery_period'
+]
+
+
+def _number(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _partition_key(region, minpaku_law, operation_type):
+    # 別名（tokyo など）は都道府県名にそろえ、同じ木に入れる
+    region = str(region)
+    return get_market_table().aliases.get(region, region), str(minpaku_law), str(operation_type)
+
+
+def _features(area, capacity, operation_type, monthly_rent, purchase_price):
+    """距離を測る座標（面積・金額は約1.4倍、収容人数は2名の差が距離1）"""
+    cost = monthly_rent if operation_type == SUBLEASE else purchase_price
+    point = array('f', (
+        math.log2(max(_number(area), 1.0)) * 2,
+        _number(capacity) / 2,
+        math.log2(max(_number(cost), 1.0)) * 2
+    ))
+    # 葉に格納するfloat32の値で木をたどる
+    return point.tolist()
+
+
+class _Leaf:
+    __slots__ = ('xs', 'ys', 'zs', 'ids', 'low', 'high')
+
+    def __init__(self):
+        self.xs = array('f')
+        self.ys = array('f')
+        self.zs = array('f')
+        self.ids = array('q')
+        # 格納している座標の範囲
+        self.low = [math.inf] * 3
+        self.high = [-math.inf] * 3
+
+    @classmethod
+    def select(cls, leaf, mask):
+        """leaf のうち mask が真の点からなる葉"""
+        selected = cls()
+        selected.xs = array('f', compress(leaf.xs, mask))
+        selected.ys = array('f', compress(leaf.ys, mask))
+        selected.zs = array('f', compress(leaf.zs, mask))
+        selected.ids = array('q', compress(leaf.ids, mask))
+        columns = (selected.xs, selected.ys, selected.zs)
+        selected.low = [min(column) for column in columns]
+        selected.high = [max(column) for column in columns]
+        return selected
+
+    def add(self, point, simulation_id):
+        x, y, z = point
+        low, high = self.low, self.high
+        if x < low[0]:
+            low[0] = x
+        if x > high[0]:
+            high[0] = x
+        if y < low[1]:
+            low[1] = y
+        if y > high[1]:
+            high[1] = y
+        if z < low[2]:
+            low[2] = z
+        if z > high[2]:
+            high[2] = z
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+        self.ids.append(simulation_id)
+
+
+class _Tree:
+    """1区分のKD木
+
+    内部ノードは dims・splits・lows・highs の配列で表し、子の参照は0以上なら内部ノード、
+    負数なら葉（~番号）。座標が splits 未満なら lows 側、以上なら highs 側に入る。
+    """
+
+    def __init__(self):
+        self.dims = array('b')
+        self.splits = array('d')
+        self.lows = array('l')
+        self.highs = array('l')
+        self.leaves = [_Leaf()]
+        self.root = ~0
+        self.size = 0
+
+    def insert(self, point, simulation_id):
+        dims, splits = self.dims, self.splits
+        parent = -1
+        node = self.root
+        while node >= 0:
+            parent = node
+            node = self.lows[node] if point[dims[node]] < splits[node] else self.highs[node]
+
+        leaf = self.leaves[~node]
+        leaf.add(point, simulation_id)
+        self.size += 1
+        if len(leaf.ids) > LEAF_SIZE:
+            self._split(~node, parent)
+
+    def _split(self, index, parent):
+        """葉を座標の広がりが最も大きい軸の中央値で2つに分ける"""
+        leaf = self.leaves[index]
+        spreads = [high - low for low, high in zip(leaf.low, leaf.high)]
+        dim = max(range(3), key=spreads.__getitem__)
+        if spreads[dim] <= 0:
+            return
+
+        column = (leaf.xs, leaf.ys, leaf.zs)[dim]
+        values = sorted(column)
+        split = values[len(values) // 2]
+        if split == values[0]:
+            # 中央値が最小値と同じなら、それより大きい最初の値で分ける
+            split = next(value for value in values if value > split)
+
+        mask = [value < split for value in column]
+        low = _Leaf.select(leaf, mask)
+        high = _Leaf.select(leaf, [not selected for selected in mask])
+
+        node = len(self.dims)
+        self.dims.append(dim)
+        self.splits.append(split)
+        self.lows.append(~index)
+        self.highs.append(~len(self.leaves))
+        self.leaves[index] = low
+        self.leaves.append(high)
+
+        if parent < 0:
+            self.root = node
+        elif self.lows[parent] == ~index:
+            self.lows[parent] = node
+        else:
+            self.highs[parent] = node
+
+    def nearest(self, point, k):
+        """近い順のK件を [(-距離の2乗, ID)] のヒープで返す"""
+        dims, splits, lows, highs, leaves = self.dims, self.splits, self.lows, self.highs, self.leaves
+        qx, qy, qz = point
+        heap = []
+        worst = math.inf
+        # (ノード, そのノード内の点までの距離の2乗の下限)
+        stack = [(self.root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound >= worst:
+                continue
+            # 近い側をたどり、遠い側は分割面までの距離を下限として後で調べる
+            while node >= 0:
+                diff = point[dims[node]] - splits[node]
+                if diff < 0:
+                    near, far = lows[node], highs[node]
+                else:
+                    near, far = highs[node], lows[node]
+                far_bound = diff * diff
+                stack.append((far, far_bound if far_bound > bound else bound))
+                node = near
+
+            leaf = leaves[~node]
+            low, high = leaf.low, leaf.high
+            box = 0.0
+            for value, lower, upper in ((qx, low[0], high[0]), (qy, low[1], high[1]), (qz, low[2], high[2])):
+                if value < lower:
+                    box += (lower - value) ** 2
+                elif value > upper:
+                    box += (value - upper) ** 2
+            if box >= worst:
+                continue
+
+            if low == high:
+                # すべて同じ座標の葉（同じ条件の保存が多い場合）は新しい順に必要な件数だけ取る
+                for simulation_id in reversed(leaf.ids):
+                    if len(heap) < k:
+                        heappush(heap, (-box, simulation_id))
+                    else:
+                        heapreplace(heap, (-box, simulation_id))
+                    if len(heap) == k:
+                        worst = -heap[0][0]
+                        if box >= worst:
+                            break
+                continue
+
+            for x, y, z, simulation_id in zip(leaf.xs, leaf.ys, leaf.zs, leaf.ids):
+                distance = (x - qx) ** 2 + (y - qy) ** 2 + (z - qz) ** 2
+                if distance < worst:
+                    if len(heap) < k:
+                        heappush(heap, (-distance, simulation_id))
+                        if len(heap) == k:
+                            worst = -heap[0][0]
+                    else:
+                        heapreplace(heap, (-distance, simulation_id))
+                        worst = -heap[0][0]
+        return heap
+
+
+class ComparablesIndex:
+    """保存済みシミュレーションの区分別KD木"""
+
+    def __init__(self, refresh_ms=COMPARABLES_REFRESH_MS):
+        self.refresh_interval = refresh_ms / 1000
+        self.loaded = False
+        self.size = 0
+        # 読み込み済みの最大ID（これ以下はすべて索引にある）と、それより後で追加済みのID
+        self.last_id = 0
+        self._ahead = set()
+        self._trees = {}
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._next_refresh = 0.0
+
+    def _insert(self, row):
+        simulation_id, region, minpaku_law, operation_type, area, capacity, monthly_rent, purchase_price = row
+        key = _partition_key(region, minpaku_law, operation_type)
+        tree = self._trees.get(key)
+        if tree is None:
+            tree = self._trees[key] = _Tree()
+        tree.insert(_features(area, capacity, operation_type, monthly_rent, purchase_price), simulation_id)
+        self.size += 1
+
+    def _advance(self):
+        while self.last_id + 1 in self._ahead:
+            self.last_id += 1
+            self._ahead.discard(self.last_id)
+
+    def refresh(self, wait=True):
+        """前回読んだIDより後の行をテーブルから読み込む"""
+        if not self._refreshing.acquire(blocking=wait):
+            return
+        try:
+            with get_connection() as conn:
+                while True:
+                    rows = conn.execute(SELECT_INDEX_ROWS_SQL, (self.last_id, LOAD_CHUNK_SIZE)).fetchall()
+                    if not rows:
+                        break
+                    with self._lock:
+                        for row in rows:
+                            if row[0] in self._ahead:
+                                self._ahead.discard(row[0])
+                            elif row[0] > self.last_id:
+                                self._insert(row)
+                        self.last_id = max(self.last_id, rows[-1][0])
+                        self._advance()
+                    if len(rows) < LOAD_CHUNK_SIZE:
+                        break
+            self.loaded = True
+        except sqlite3.OperationalError as e:
+            # テーブルが未作成（INIT_DATABASE=0 で起動した直後など）なら次の検索時に再試行
+            print(f"Comparables index error: {e}")
+        finally:
+            self._next_refresh = time.monotonic() + self.refresh_interval
+            self._refreshing.release()
+
+    def add_saved(self, saved):
+        """保存のコミット後に追加（ingestの書き込みスレッドから [(ID, INSERTのパラメーター)] で呼ばれる）"""
+        if not self.loaded:
+            return
+        with self._lock:
+            for simulation_id, params in saved:
+                if simulation_id <= self.last_id or simulation_id in self._ahead:
+                    continue
+                self._insert((simulation_id, params[1], params[6], params[2], params[4], params[5], params[7], params[8]))
+                self._ahead.add(simulation_id)
+            self._advance()
+
+    def nearest(self, scenario, k=COMPARABLES_K):
+        """シナリオと同じ区分で条件が近いシミュレーションの [(ID, 距離)]（近い順）"""
+        if not self.loaded:
+            self.refresh()
+        elif time.monotonic() >= self._next_refresh:
+            # 他のスレッドが読み込み中なら待たずに現在の索引で検索する
+            self.refresh(wait=False)
+
+        tree = self._trees.get(_partition_key(scenario['region'], scenario['minpakuLaw'], scenario['operationType']))
+        if tree is None:
+            return []
+        point = _features(
+            scenario['area'], scenario['capacity'], scenario['operationType'],
+            scenario['monthlyRent'], scenario['purchasePrice']
+        )
+        with self._lock:
+            heap = tree.nearest(point, k)
+        return [(simulation_id, math.sqrt(-distance)) for distance, simulation_id in sorted(heap, reverse=True)]
+
+
+def _quantile(values, q):
+    position = q * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def roi_distribution(rois):
+    """ROIの分布（最小・四分位・最大・平均）"""
+    values = sorted(roi for roi in rois if roi is not None)
+    if not values:
+        return None
+    return {
+        'min': round(values[0], 2),
+        'p25': round(_quantile(values, 0.25), 2),
+        'median': round(_quantile(values, 0.5), 2),
+        'p75': round(_quantile(values, 0.75), 2),
+        'max': round(values[-1], 2),
+        'mean': round(sum(values) / len(values), 2)
+    }
+
+
+def fetch_comparables(ids):
+    """IDの行をまとめて取得（{ID: 行}）"""
+    if not ids:
+        return {}
+    placeholders = ', '.join('?' * len(ids))
+    with get_connection() as conn:
+        rows = conn.execute(
+            f"SELECT {', '.join(COMPARABLE_COLUMNS)} FROM simulations WHERE id IN ({placeholders})", ids
+        ).fetchall()
+    return {row[0]: row for row in rows}
+
+
+def find_comparables(scenario, k=COMPARABLES_K):
+    """条件の近い保存済みシミュレーション（近い順）と、そのROIの分布"""
+    neighbours = index.nearest(scenario, k)
+    rows = fetch_comparables([simulation_id for simulation_id, _ in neighbours])
+
+    items = []
+    for simulation_id, distance in neighbours:
+        row = rows.get(simulation_id)
+        if row is not None:
+            item = dict(zip(COMPARABLE_COLUMNS, row))
+            item['distance'] = round(distance, 3)
+            items.append(item)
+
+    return {
+        'count': len(items),
+        'items': items,
+        'roi': roi_distribution(item['roi'] for item in items)
+    }
+
+
+index = ComparablesIndex()
@@ -0,0 +1,245 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import stage_seconds
+from rollups import ROLLUP_SCHEMA, rebuild_rollups
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'database/simulations.db')
+
+# プール設定
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+# 接続ごとにキャッシュするプリペアドステートメント数
+STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', '128'))
+
+# 接続作成時に設定するPRAGMA
+PRAGMAS = {
+    'journal_mode': os.environ.get('DB_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('DB_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': os.environ.get('DB_CACHE_SIZE', '-16000'),
+    'mmap_size': os.environ.get('DB_MMAP_SIZE', '268435456'),
+    'temp_store': 'MEMORY',
+    'busy_timeout': str(BUSY_TIMEOUT_MS)
+}
+
+
+class ConnectionPool:
+    """プロセス内で共有するSQLite接続プール（fork後は作り直す）"""
+
+    def __init__(self, path=DATABASE_PATH, size=POOL_SIZE, pragmas=None, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.pragmas = dict(PRAGMAS if pragmas is None else pragmas)
+        self.timeout = timeout
+        self.opened = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _connect(self):
+        started = time.perf_counter()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        self.opened += 1
+        stage_seconds.observe(time.perf_counter() - started, 'db_connect')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """接続を借りて返す（正常終了でcommit、例外時はrollback）"""
+        with self._lock:
+            # fork前の接続は子プロセスでは使わない
+            if self._pid != os.getpid():
+                self._reset()
+            idle, slots = self._idle, self._slots
+
+        if not slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('Connection pool exhausted')
+        try:
+            try:
+                conn = idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+        except Exception:
+            slots.release()
+            raise
+
+        try:
+            # 接続を借りている間（クエリ実行）とコミットの時間を分けて記録
+            started = time.perf_counter()
+            yield conn
+            stage_seconds.observe(time.perf_counter() - started, 'db_query')
+            if conn.in_transaction:
+                started = time.perf_counter()
+                conn.commit()
+                stage_seconds.observe(time.perf_counter() - started, 'db_commit')
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            idle.put(conn)
+            slots.release()
+
+    def close_all(self):
+        """待機中の接続をすべて閉じる"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        return {'size': self.size, 'idle': self._idle.qsize(), 'opened': self.opened}
+
+
+def _create_rollups(conn):
+    conn.execute(ROLLUP_SCHEMA)
+    rebuild_rollups(conn)
+
+
+# スキーマのマイグレーション（PRAGMA user_versionで適用済みの版を管理）
+# SQLスクリプトか、接続を受け取る関数のどちらかを並べる
+MIGRATIONS = [
+    # 1: シミュレーション結果テーブル
+    '''
+    CREATE TABLE IF NOT EXISTS simulations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        region TEXT,
+        operation_type TEXT,
+        property_type TEXT,
+        area INTEGER,
+        capacity INTEGER,
+        minpaku_law TEXT,
+        monthly_rent INTEGER,
+        purchase_price INTEGER,
+        renovation_cost INTEGER,
+        initial_cost INTEGER,
+        annual_revenue INTEGER,
+        annual_costs INTEGER,
+        annual_profit INTEGER,
+        roi REAL,
+        recovery_period REAL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''',
+    # 2: ユーザー別の検索用インデックスと、ユーザーごとの最新結果テーブル
+    '''
+    CREATE INDEX IF NOT EXISTS idx_simulations_user_created
+        ON simulations (user_id, created_at, id);
+
+    CREATE TABLE IF NOT EXISTS latest_simulation (
+        user_id TEXT PRIMARY KEY,
+        simulation_id INTEGER NOT NULL
+    );
+
+    INSERT OR REPLACE INTO latest_simulation (user_id, simulation_id)
+        SELECT user_id, MAX(id) FROM simulations
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id;
+
+    CREATE TRIGGER IF NOT EXISTS trg_simulations_latest_insert
+    AFTER INSERT ON simulations
+    WHEN NEW.user_id IS NOT NULL
+    BEGIN
+        INSERT OR REPLACE INTO latest_simulation (user_id, simulation_id)
+            VALUES (NEW.user_id, NEW.id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_simulations_latest_delete
+    AFTER DELETE ON simulations
+    WHEN OLD.id = (SELECT simulation_id FROM latest_simulation WHERE user_id = OLD.user_id)
+    BEGIN
+        DELETE FROM latest_simulation WHERE user_id = OLD.user_id;
+        INSERT INTO latest_simulation (user_id, simulation_id)
+            SELECT user_id, MAX(id) FROM simulations
+            WHERE user_id = OLD.user_id
+            GROUP BY user_id;
+    END;
+    ''',
+    # 3: 地域×民泊法×運営形態×日の集計テーブル（既存データから作成）
+    _create_rollups,
+    # 4: 履歴表示の列を含むカバリングインデックス（2のインデックスを置き換え）
+    '''
+    CREATE INDEX IF NOT EXISTS idx_simulations_user_history
+        ON simulations (
+            user_id, created_at, id,
+            region, property_type, minpaku_law, capacity,
+            annual_profit, roi, recovery_period
+        );
+
+    DROP INDEX IF EXISTS idx_simulations_user_created;
+    '''
+]
+
+
+pool = ConnectionPool()
+
+
+def get_connection():
+    """プールから接続を取得（with文で使用）"""
+    return pool.connection()
+
+
+def open_connection():
+    """プールを通さない接続（長時間読み続けるエクスポート用。使い終わったら close する）"""
+    return pool._connect()
+
+
+def _statements(script):
+    """SQLスクリプトを文ごとに分割（トリガー本体の ; では区切らない）"""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+    if statement.strip():
+        yield statement
+
+
+def init_database():
+    """データベースを初期化し、未適用のマイグレーションを実行
+
+    複数のワーカーが同時に起動しても、書き込みロックを取ってから版を確認するので
+    同じマイグレーションが二重に適用されることはない。
+    """
+    with get_connection() as conn:
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return
+            migration = MIGRATIONS[version]
+            try:
+                if callable(migration):
+                    migration(conn)
+                else:
+                    # executescript は先にCOMMITしてしまうので文ごとに実行
+                    for statement in _statements(migration):
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
@@ -0,0 +1,247 @@
+"""保存済みシミュレーションのエクスポート
+
+APIの /api/simulation/export とコマンドラインの両方から使う。
+
+    python export.py --format csv --from 2025-01-01 --to 2025-02-01 --region 東京都 > out.csv
+
+columnar形式のレイアウト（数値はすべてリトルエンディアン）:
+    ヘッダ   b'MPKCOL1\\n' + uint32 スキーマ長 + スキーマJSON [{"name", "type"}]
+    ブロック uint32 行数 + 列ごとに [uint8 NULL有無, (NULL有無=1なら) 行数バイトのNULLマスク, 値]
+             値は int=int64配列 / real=float64配列 / text=uint32終端オフセット配列 + UTF-8データ
+    終端     uint32 0
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import struct
+import sys
+import threading
+from array import array
+from datetime import datetime
+
+from db import open_connection
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/octet-stream'
+}
+
+# エクスポートする列と型
+EXPORT_COLUMNS = [
+    ('id', 'int'),
+    ('user_id', 'text'),
+    ('region', 'text'),
+    ('operation_type', 'text'),
+    ('property_type', 'text'),
+    ('area', 'int'),
+    ('capacity', 'int'),
+    ('minpaku_law', 'text'),
+    ('monthly_rent', 'int'),
+    ('purchase_price', 'int'),
+    ('renovation_cost', 'int'),
+    ('initial_cost', 'int'),
+    ('annual_revenue', 'int'),
+    ('annual_costs', 'int'),
+    ('annual_profit', 'int'),
+    ('roi', 'real'),
+    ('recovery_period', 'real'),
+    ('created_at', 'text')
+]
+COLUMN_NAMES = [name for name, _ in EXPORT_COLUMNS]
+
+CHUNK_SIZE = 1000
+COLUMNAR_MAGIC = b'MPKCOL1\n'
+
+# 同時に実行できるエクスポート数（APIの接続プールとは別に、1件ごとに接続を開く）
+EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT', '2'))
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+class ExportBusy(Exception):
+    """同時に実行できるエクスポート数を超えている"""
+
+
+def parse_filters(date_from=None, date_to=None, region=None, user_id=None):
+    """絞り込み条件を検証（日付はYYYY-MM-DDまたはISO形式）"""
+    filters = {}
+    for key, value in (('from', date_from), ('to', date_to)):
+        if value:
+            try:
+                filters[key] = datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise ValueError(f'Invalid date for {key}: {value}')
+    if region:
+        filters['region'] = region
+    if user_id:
+        filters['user_id'] = user_id
+    return filters
+
+
+def build_query(filters):
+    conditions = []
+    params = []
+    if 'from' in filters:
+        conditions.append('created_at >= ?')
+        params.append(filters['from'])
+    if 'to' in filters:
+        conditions.append('created_at < ?')
+        params.append(filters['to'])
+    if 'region' in filters:
+        conditions.append('region = ?')
+        params.append(filters['region'])
+    if 'user_id' in filters:
+        conditions.append('user_id = ?')
+        params.append(filters['user_id'])
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f"SELECT {', '.join(COLUMN_NAMES)} FROM simulations {where} ORDER BY id", params
+
+
+def iter_chunks(conn, filters, chunk_size=CHUNK_SIZE):
+    """カーソルからfetchmanyで少しずつ行を読み出す"""
+    sql, params = build_query(filters)
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def stream_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMN_NAMES)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+def stream_ndjson(chunks):
+    for rows in chunks:
+        yield ''.join(
+            json.dumps(dict(zip(COLUMN_NAMES, row)), ensure_ascii=False) + '\n' for row in rows
+        )
+
+
+def _numeric(value, cast):
+    try:
+        return cast(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _encode_column(values, column_type):
+    if column_type == 'text':
+        values = [str(value).encode('utf-8') if value is not None else None for value in values]
+    elif column_type == 'int':
+        values = [_numeric(value, int) for value in values]
+    else:
+        values = [_numeric(value, float) for value in values]
+
+    nulls = bytes(1 if value is None else 0 for value in values)
+    parts = [struct.pack('<B', 1 if any(nulls) else 0)]
+    if any(nulls):
+        parts.append(nulls)
+
+    if column_type == 'text':
+        offsets = array('I')
+        end = 0
+        for value in values:
+            end += len(value) if value is not None else 0
+            offsets.append(end)
+        data = b''.join(value for value in values if value is not None)
+        parts += [_little_endian(offsets), data]
+    else:
+        typecode = 'q' if column_type == 'int' else 'd'
+        parts.append(_little_endian(array(typecode, [value if value is not None else 0 for value in values])))
+    return b''.join(parts)
+
+
+def _little_endian(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def stream_columnar(chunks):
+    schema = json.dumps([{'name': name, 'type': column_type} for name, column_type in EXPORT_COLUMNS]).encode('utf-8')
+    yield COLUMNAR_MAGIC + struct.pack('<I', len(schema)) + schema
+    for rows in chunks:
+        columns = list(zip(*rows))
+        yield struct.pack('<I', len(rows)) + b''.join(
+            _encode_column(values, column_type)
+            for values, (_, column_type) in zip(columns, EXPORT_COLUMNS)
+        )
+    yield struct.pack('<I', 0)
+
+
+STREAMS = {
+    'csv': stream_csv,
+    'ndjson': stream_ndjson,
+    'columnar': stream_columnar
+}
+
+
+class ExportStream:
+    """指定形式のエクスポートを少しずつ生成する（専用の接続で読み、close() で閉じる）
+
+    WSGIサーバーはクライアントが途中で切断した場合もレスポンスの close() を呼ぶので、
+    ダウンロードが遅くてもAPIの接続プールは占有しない。
+    """
+
+    def __init__(self, export_format, filters, chunk_size=CHUNK_SIZE):
+        if export_format not in STREAMS:
+            raise ValueError(f'Unsupported export format: {export_format}')
+        if not _export_slots.acquire(blocking=False):
+            raise ExportBusy(f'Too many exports in progress (max {EXPORT_MAX_CONCURRENT})')
+        try:
+            self._conn = open_connection()
+        except Exception:
+            _export_slots.release()
+            raise
+        self._parts = STREAMS[export_format](iter_chunks(self._conn, filters, chunk_size))
+
+    def __iter__(self):
+        return self._parts
+
+    def close(self):
+        if self._conn is None:
+            return
+        self._parts.close()
+        self._conn.close()
+        self._conn = None
+        _export_slots.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='保存済みシミュレーションのエクスポート')
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--from', dest='date_from')
+    parser.add_argument('--to', dest='date_to')
+    parser.add_argument('--region')
+    parser.add_argument('--user', dest='user_id')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--output', help='出力ファイル（省略時は標準出力）')
+    args = parser.parse_args(argv)
+
+    filters = parse_filters(args.date_from, args.date_to, args.region, args.user_id)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    stream = ExportStream(args.format, filters, args.chunk_size)
+    try:
+        for part in stream:
+            out.write(part if isinstance(part, bytes) else part.encode('utf-8'))
+    finally:
+        stream.close()
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
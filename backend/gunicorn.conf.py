@@ -0,0 +1,26 @@
+"""gunicornの設定（backend で gunicorn main:app と起動すると読み込まれる）
+
+アプリはマスタープロセスで1回だけ作成し（preload）、ワーカーとコピーオンライトで共有する。
+DB接続・HTTPセッション・バックグラウンドスレッドはfork後に各ワーカーで作成される。
+"""
+import gc
+import importlib
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# 初回利用時に読み込むモジュール（preload時はマスターで読み込んでワーカーと共有する）
+SHARED_MODULES = ('requests', 'risk', 'projection', 'export', 'optimizer')
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    for name in SHARED_MODULES:
+        importlib.import_module(name)
+    # GCが共有ページのオブジェクトに書き込んでコピーが起きないよう、fork前に凍結する
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,208 @@
+import atexit
+import os
+import threading
+import time
+
+from db import get_connection
+from rollups import record_rollups
+
+# グループコミットの設定（N件たまるか、Mミリ秒経過でまとめて書き込む）
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', '200'))
+INGEST_FLUSH_MS = float(os.environ.get('INGEST_FLUSH_MS', '20'))
+INGEST_BUFFER_SIZE = int(os.environ.get('INGEST_BUFFER_SIZE', '10000'))
+# 保存APIの既定動作（1: 書き込み完了を待ってIDを返す、0: 受け付けだけして返す）
+INGEST_SYNC_DEFAULT = os.environ.get('INGEST_SYNC_DEFAULT', '1') == '1'
+
+INSERT_SIMULATION_SQL = '''
+    INSERT INTO simulations (
+        user_id, region, operation_type, property_type, area, capacity,
+        minpaku_law, monthly_rent, purchase_price, renovation_cost,
+        initial_cost, annual_revenue, annual_costs, annual_profit,
+        roi, recovery_period
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class BufferFull(Exception):
+    """書き込みバッファがいっぱいで受け付けられない"""
+
+
+class _Pending:
+    __slots__ = ('params', 'done', 'simulation_id', 'error', 'callback')
+
+    def __init__(self, params, callback=None):
+        self.params = params
+        self.callback = callback
+        self.done = threading.Event()
+        self.simulation_id = None
+        self.error = None
+
+
+class SimulationWriter:
+    """保存をバッファにため、1トランザクションでまとめて書き込む"""
+
+    def __init__(self, batch_size=INGEST_BATCH_SIZE, flush_ms=INGEST_FLUSH_MS, buffer_size=INGEST_BUFFER_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._condition = threading.Condition()
+        self._pid = None
+        self._flushing = threading.Lock()
+        self._listeners = []
+        self.stats = {
+            'batches': 0,
+            'rows': 0,
+            'failedRows': 0,
+            'lastBatchSize': 0,
+            'maxBatchSize': 0,
+            'lastFlushMs': 0.0,
+            'maxFlushMs': 0.0,
+            'totalFlushMs': 0.0
+        }
+
+    def add_listener(self, callback):
+        """コミット後に呼ぶ関数を登録（保存できた行の [(ID, INSERTのパラメーター)] を渡す）"""
+        self._listeners.append(callback)
+
+    def _start(self):
+        """書き込みスレッドを初回利用時（fork後）に起動"""
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._buffer = []
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _enqueue(self, params, callback=None):
+        self._start()
+        pending = _Pending(params, callback)
+        with self._condition:
+            if len(self._buffer) >= self.buffer_size:
+                raise BufferFull('Ingest buffer is full')
+            self._buffer.append(pending)
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+        return pending
+
+    def submit(self, params, wait=True, timeout=30):
+        """保存を受け付ける。wait=Trueならコミット後のIDを返す"""
+        pending = self._enqueue(params)
+        if not wait:
+            return None
+        if not pending.done.wait(timeout):
+            raise TimeoutError('Timed out waiting for the simulation to be saved')
+        if pending.error is not None:
+            raise pending.error
+        return pending.simulation_id
+
+    async def submit_async(self, params, timeout=30):
+        """イベントループから使う版（スレッドを塞がずにコミットを待ち、IDを返す）"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(pending):
+            if not future.done():
+                if pending.error is not None:
+                    future.set_exception(pending.error)
+                else:
+                    future.set_result(pending.simulation_id)
+
+        def notify(pending):
+            # 書き込みスレッドから呼ばれるので、結果はイベントループ側で設定する
+            try:
+                loop.call_soon_threadsafe(resolve, pending)
+            except RuntimeError:
+                pass  # イベントループが終了済み
+
+        self._enqueue(params, notify)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Timed out waiting for the simulation to be saved')
+
+    def pending(self):
+        return len(self._buffer)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._buffer) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """バッファの内容を書き込む"""
+        with self._flushing:
+            with self._condition:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+            if not batch:
+                return
+
+            started = time.perf_counter()
+            try:
+                self._write(batch)
+            except Exception:
+                # 1件の不正データでバッチ全体を失わないよう、1件ずつ書き直す
+                for pending in batch:
+                    try:
+                        self._write([pending])
+                    except Exception as e:
+                        pending.error = e
+                        self.stats['failedRows'] += 1
+                        print(f"Ingest error: {e}")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            saved = [(pending.simulation_id, pending.params) for pending in batch if pending.error is None]
+            for callback in self._listeners:
+                try:
+                    callback(saved)
+                except Exception as e:
+                    print(f"Ingest listener error: {e}")
+
+            for pending in batch:
+                pending.done.set()
+                if pending.callback is not None:
+                    pending.callback(pending)
+
+            stats = self.stats
+            stats['batches'] += 1
+            stats['rows'] += len(batch)
+            stats['lastBatchSize'] = len(batch)
+            stats['maxBatchSize'] = max(stats['maxBatchSize'], len(batch))
+            stats['lastFlushMs'] = elapsed_ms
+            stats['maxFlushMs'] = max(stats['maxFlushMs'], elapsed_ms)
+            stats['totalFlushMs'] += elapsed_ms
+
+    def _write(self, batch):
+        with get_connection() as conn:
+            conn.executemany(INSERT_SIMULATION_SQL, [pending.params for pending in batch])
+            # 同一トランザクション内の連続挿入なのでIDは連番になる
+            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            for offset, pending in enumerate(batch):
+                pending.simulation_id = last_id - len(batch) + 1 + offset
+            record_rollups(conn, [
+                (pending.params[1], pending.params[6], pending.params[2], pending.params[14], pending.params[15])
+                for pending in batch
+            ])
+
+    def close(self):
+        """残りを書き込む（終了時）"""
+        if self._pid != os.getpid():
+            return
+        while self._buffer:
+            self.flush()
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats['pending'] = self.pending()
+        stats['avgBatchSize'] = stats['rows'] / stats['batches'] if stats['batches'] else 0
+        stats['avgFlushMs'] = stats['totalFlushMs'] / stats['batches'] if stats['batches'] else 0
+        return stats
+
+
+writer = SimulationWriter()
+atexit.register(writer.close)
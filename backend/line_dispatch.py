@@ -0,0 +1,192 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+
+from metrics import timed
+
+# 送信先（ローカルのスタブサーバーに向ける場合は LINE_API_BASE を変更）
+LINE_API_BASE = os.environ.get('LINE_API_BASE', 'https://api.line.me')
+
+DISPATCH_WORKERS = int(os.environ.get('LINE_DISPATCH_WORKERS', '4'))
+QUEUE_SIZE = int(os.environ.get('LINE_DISPATCH_QUEUE_SIZE', '10000'))
+MAX_RETRIES = int(os.environ.get('LINE_DISPATCH_MAX_RETRIES', '5'))
+BACKOFF_BASE = float(os.environ.get('LINE_DISPATCH_BACKOFF', '0.5'))
+BACKOFF_MAX = float(os.environ.get('LINE_DISPATCH_BACKOFF_MAX', '30'))
+REQUEST_TIMEOUT = float(os.environ.get('LINE_DISPATCH_TIMEOUT', '10'))
+DEAD_LETTER_PATH = os.environ.get('LINE_DEAD_LETTER_PATH', 'database/line_dead_letter.ndjson')
+# 終了時に送信待ちのメッセージを待つ秒数（残りは未送信として記録する）
+SHUTDOWN_TIMEOUT = float(os.environ.get('LINE_DISPATCH_SHUTDOWN_TIMEOUT', '10'))
+
+# 再送対象のステータスコード
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LineDispatcher:
+    """LINEへのpush送信をバックグラウンドで行う送信キュー"""
+
+    def __init__(self, access_token, api_base=LINE_API_BASE, workers=DISPATCH_WORKERS,
+                 queue_size=QUEUE_SIZE, max_retries=MAX_RETRIES, dead_letter_path=DEAD_LETTER_PATH):
+        self.access_token = access_token
+        self.api_base = api_base.rstrip('/')
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+        self.stats = {'queued': 0, 'sent': 0, 'retried': 0, 'deadLettered': 0}
+        self.status_codes = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._session = None
+        self._stopping = threading.Event()
+
+    def _start(self):
+        """送信スレッドとHTTPセッションを初回利用時（fork後）に作成"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # requestsは初回送信時（fork後）に読み込む（起動時間・ワーカーのメモリを抑える）
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._stopping = threading.Event()
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+            self._session.headers.update({
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {self.access_token}'
+            })
+            for _ in range(self.workers):
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def push(self, user_id, messages):
+        """push送信をキューに積む（ブロックしない）"""
+        if isinstance(messages, str):
+            messages = [{'type': 'text', 'text': messages}]
+        self._start()
+        payload = {'to': user_id, 'messages': messages}
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            self._dead_letter(payload, 'queue full')
+            return False
+        with self._lock:
+            self.stats['queued'] += 1
+        return True
+
+    def join(self):
+        """キューが空になるまで待つ"""
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self, timeout=SHUTDOWN_TIMEOUT):
+        """終了時に送信待ちのメッセージを timeout 秒まで送り、残りは未送信として記録する"""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        self._wait_idle(deadline)
+
+        # 再送待ちを打ち切り（送信スレッドが記録する）、キューに残ったものを記録
+        self._stopping.set()
+        while True:
+            try:
+                payload = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._dead_letter(payload, 'shutdown')
+            self._queue.task_done()
+        self._wait_idle(max(deadline, time.monotonic() + 1))
+
+    def _wait_idle(self, deadline):
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._queue.all_tasks_done.wait(remaining)
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _run(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                self._deliver(payload)
+            except Exception as e:
+                self._dead_letter(payload, str(e))
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, payload):
+        """送信し、429/5xx・通信エラー時は指数バックオフで再送"""
+        # _start で読み込み済み（ここではモジュール参照を得るだけ）
+        import requests
+
+        url = f'{self.api_base}/v2/bot/message/push'
+        reason = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                with self._lock:
+                    self.stats['retried'] += 1
+            retry_after = None
+            try:
+                with timed('line_send'):
+                    response = self._session.post(url, data=json.dumps(payload), timeout=REQUEST_TIMEOUT)
+                self._count_status(response.status_code)
+                if response.status_code == 200:
+                    with self._lock:
+                        self.stats['sent'] += 1
+                    return True
+                reason = f'HTTP {response.status_code}'
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                retry_after = response.headers.get('Retry-After')
+            except requests.RequestException as e:
+                reason = str(e)
+
+            if attempt < self.max_retries and self._stopping.wait(self._backoff(attempt, retry_after)):
+                reason = f'{reason} (shutdown)'
+                break
+
+        self._dead_letter(payload, reason)
+        return False
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+        delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+        return delay * (0.5 + random.random() / 2)
+
+    def _count_status(self, status_code):
+        with self._lock:
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+
+    def _dead_letter(self, payload, reason):
+        """送信できなかったメッセージを記録"""
+        with self._lock:
+            self.stats['deadLettered'] += 1
+            print(f"LINE dispatch failed ({reason}): to={payload.get('to')}")
+            if not self.dead_letter_path:
+                return
+            try:
+                directory = os.path.dirname(self.dead_letter_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({
+                        'failedAt': datetime.now().isoformat(),
+                        'reason': reason,
+                        'payload': payload
+                    }, ensure_ascii=False) + '\n')
+            except OSError as e:
+                print(f"Dead letter write error: {e}")
+
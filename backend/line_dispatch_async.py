@@ -0,0 +1,107 @@
+"""ASGIモード用のLINE送信キュー（asyncio・httpxを使うため、Flaskアプリからは読み込まない）"""
+import asyncio
+import json
+
+from line_dispatch import REQUEST_TIMEOUT, RETRY_STATUSES, LineDispatcher
+from metrics import timed
+
+
+class AsyncLineDispatcher(LineDispatcher):
+    """イベントループ上で動く送信キュー（ASGIモード用。httpxで非同期に送信）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = None
+        self._client = None
+        self._tasks = []
+
+    def _start(self):
+        """送信タスクとHTTPクライアントを実行中のイベントループ上に作成"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        import httpx
+
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._client = httpx.AsyncClient(
+            headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {self.access_token}'},
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers)
+        )
+        self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+
+    def push(self, user_id, messages):
+        """push送信をキューに積む（イベントループ上から呼ぶ。ブロックしない）"""
+        if isinstance(messages, str):
+            messages = [{'type': 'text', 'text': messages}]
+        self._start()
+        payload = {'to': user_id, 'messages': messages}
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self._dead_letter(payload, 'queue full')
+            return False
+        self.stats['queued'] += 1
+        return True
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self):
+        """送信タスクを止めてHTTPクライアントを閉じる（終了時。送信待ちのメッセージは未送信として記録）"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self._queue is not None and not self._queue.empty():
+            self._dead_letter(self._queue.get_nowait(), 'shutdown')
+            self._queue.task_done()
+        if self._client is not None:
+            await self._client.aclose()
+        self._loop = None
+
+    async def _run(self):
+        while True:
+            payload = await self._queue.get()
+            try:
+                await self._deliver(payload)
+            except asyncio.CancelledError:
+                # 送信中・再送待ちのまま終了する
+                self._dead_letter(payload, 'shutdown')
+                raise
+            except Exception as e:
+                self._dead_letter(payload, str(e))
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, payload):
+        """送信し、429/5xx・通信エラー時は指数バックオフで再送"""
+        import httpx
+
+        url = f'{self.api_base}/v2/bot/message/push'
+        reason = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats['retried'] += 1
+            retry_after = None
+            try:
+                with timed('line_send'):
+                    response = await self._client.post(url, content=json.dumps(payload))
+                self._count_status(response.status_code)
+                if response.status_code == 200:
+                    self.stats['sent'] += 1
+                    return True
+                reason = f'HTTP {response.status_code}'
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                retry_after = response.headers.get('Retry-After')
+            except httpx.HTTPError as e:
+                reason = str(e) or type(e).__name__
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        self._dead_letter(payload, reason)
+        return False
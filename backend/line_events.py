@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# LINEのpush APIで1回に送れるメッセージ数
+MAX_MESSAGES_PER_PUSH = 5
+
+DEDUP_SIZE = int(os.environ.get('LINE_DEDUP_SIZE', '10000'))
+DEDUP_TTL = float(os.environ.get('LINE_DEDUP_TTL', '3600'))
+
+
+class EventDeduplicator:
+    """処理済みのwebhookEventIdを一定数・一定時間だけ覚えておく"""
+
+    def __init__(self, max_size=DEDUP_SIZE, ttl=DEDUP_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.duplicates = 0
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, event_id):
+        """初めて見るIDならTrue、処理済み（再送）ならFalse"""
+        if not event_id:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            # 期限切れを古い順に捨てる
+            while self._seen:
+                oldest_id, expires_at = next(iter(self._seen.items()))
+                if expires_at > now:
+                    break
+                del self._seen[oldest_id]
+
+            if event_id in self._seen:
+                self.duplicates += 1
+                return False
+
+            self._seen[event_id] = now + self.ttl
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def discard(self, event_ids):
+        """IDを未処理に戻す（処理に失敗し、LINEからの再送を受け付ける場合）"""
+        with self._lock:
+            for event_id in event_ids:
+                self._seen.pop(event_id, None)
+
+    @contextmanager
+    def claim(self):
+        """with内で処理済みにしたIDを、例外で抜けたときに未処理に戻す
+
+            with deduplicator.claim() as claimed:
+                messages = list(text_events(events, claimed))
+                ...（返信の作成・送信キューへの追加）
+        """
+        claimed = _Claim(self)
+        try:
+            yield claimed
+        except BaseException:
+            self.discard(claimed.event_ids)
+            raise
+
+
+class _Claim:
+    """1回のWebhookで処理済みにしたIDの記録"""
+
+    def __init__(self, deduplicator):
+        self.deduplicator = deduplicator
+        self.event_ids = []
+
+    def check_and_add(self, event_id):
+        if not self.deduplicator.check_and_add(event_id):
+            return False
+        if event_id:
+            self.event_ids.append(event_id)
+        return True
+
+
+def text_events(events, deduplicator=None):
+    """テキストメッセージイベントを (userId, テキスト) にし、再送分を除く"""
+    for event in events:
+        if event.get('type') != 'message' or event.get('message', {}).get('type') != 'text':
+            continue
+        if deduplicator is not None and not deduplicator.check_and_add(event.get('webhookEventId')):
+            continue
+        user_id = event.get('source', {}).get('userId')
+        if user_id:
+            yield user_id, event['message']['text'].strip()
+
+
+class Outbox:
+    """ユーザーごとに返信をまとめ、5件ずつのpushにする"""
+
+    def __init__(self):
+        self._messages = OrderedDict()
+
+    def add(self, user_id, text):
+        self._messages.setdefault(user_id, []).append({'type': 'text', 'text': text})
+
+    def pushes(self):
+        """(userId, messages) の組を送信単位で返す"""
+        for user_id, messages in self._messages.items():
+            for start in range(0, len(messages), MAX_MESSAGES_PER_PUSH):
+                yield user_id, messages[start:start + MAX_MESSAGES_PER_PUSH]
@@ -0,0 +1,97 @@
+"""LINE Messaging APIのローカルスタブサーバー
+
+送信キューや負荷試験を api.line.me に繋がずに確認するためのもの。
+
+    python line_stub.py --port 8081 --fail-rate 0.2 --delay-ms 50
+    LINE_API_BASE=http://127.0.0.1:8081 python main.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, fail_rate=0.0, fail_status=500, delay_ms=0):
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.delay_ms = delay_ms
+        self.received = 0
+        self.messages = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+
+def make_handler(state):
+    class LineStubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if state.delay_ms:
+                time.sleep(state.delay_ms / 1000)
+
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                return self._reply(401, {'message': 'Authentication failed'})
+            if self.path not in ('/v2/bot/message/push', '/v2/bot/message/reply'):
+                return self._reply(404, {'message': 'Not found'})
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                return self._reply(400, {'message': 'Invalid JSON'})
+
+            with state.lock:
+                state.received += 1
+                failed = random.random() < state.fail_rate
+                if failed:
+                    state.failed += 1
+                else:
+                    state.messages += len(payload.get('messages', []))
+            if failed:
+                return self._reply(state.fail_status, {'message': 'Stub failure'})
+            self._reply(200, {})
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._reply(404, {'message': 'Not found'})
+            with state.lock:
+                self._reply(200, {
+                    'received': state.received,
+                    'messages': state.messages,
+                    'failed': state.failed
+                })
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return LineStubHandler
+
+
+def serve(host='127.0.0.1', port=8081, fail_rate=0.0, fail_status=500, delay_ms=0):
+    """スタブサーバーを作成して返す（serve_foreverは呼び出し側で実行）"""
+    state = StubState(fail_rate, fail_status, delay_ms)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.state = state
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LINE Messaging API stub server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--fail-status', type=int, default=500)
+    parser.add_argument('--delay-ms', type=int, default=0)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.fail_rate, args.fail_status, args.delay_ms)
+    print(f'LINE API stub listening on http://{args.host}:{args.port}')
+    server.serve_forever()
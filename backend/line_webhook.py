@@ -0,0 +1,81 @@
+"""LINE Webhookの受信（署名検証とJSONの解析）。main.py・asgi.py・ルートのapp.pyで共通
+
+署名は受信したバイト列に対して直接計算し、チャネルシークレットを設定済みのHMACを複製して使う。
+大きすぎる本文や形式の合わない署名は、HMACやJSONの解析の前に拒否する。
+本文の解析は1回だけで、orjson がインストールされていればそちらを使う。
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 受け付ける本文の上限（LINEのWebhookは通常数KB）
+WEBHOOK_MAX_BYTES = int(os.environ.get('LINE_WEBHOOK_MAX_BYTES', str(1024 * 1024)))
+# SHA-256（32バイト）をBase64にした署名の長さ
+SIGNATURE_LENGTH = 44
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+class WebhookError(ValueError):
+    """受け付けないWebhookリクエスト（status は返すHTTPステータス）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class LineWebhook:
+    def __init__(self, channel_secret, max_bytes=WEBHOOK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        # シークレット未設定のときは誰でも署名を作れるため、すべて拒否する
+        self._configured = bool(channel_secret)
+        # 鍵の処理はここで1回だけ行い、検証ごとに copy() する
+        self._mac = hmac.new(channel_secret.encode('utf-8'), digestmod=hashlib.sha256)
+
+    def check_length(self, content_length):
+        """Content-Length（不明ならNone）が上限を超えていれば、本文を読む前に拒否"""
+        if content_length is not None and content_length > self.max_bytes:
+            raise WebhookError('Payload too large', 413)
+
+    def verify(self, body, signature):
+        """本文（bytes）の署名を定数時間で比較"""
+        if not self._configured:
+            return False
+        if not signature or len(signature) != SIGNATURE_LENGTH:
+            return False
+        try:
+            expected = base64.b64decode(signature, validate=True)
+        except (binascii.Error, ValueError):
+            return False
+        mac = self._mac.copy()
+        mac.update(body)
+        return hmac.compare_digest(mac.digest(), expected)
+
+    def parse(self, body, signature):
+        """署名を検証して events を返す（受け付けない場合はWebhookError）"""
+        if len(body) > self.max_bytes:
+            raise WebhookError('Payload too large', 413)
+        with timed('hmac_verify'):
+            verified = self.verify(body, signature)
+        if not verified:
+            raise WebhookError('Invalid signature')
+
+        with timed('json_parse'):
+            try:
+                payload = _loads(body)
+            except ValueError:
+                raise WebhookError('Invalid JSON')
+        events = payload.get('events', []) if isinstance(payload, dict) else None
+        if not isinstance(events, list):
+            raise WebhookError('Invalid webhook payload')
+        return events
@@ -1,24 +1,181 @@
+import atexit
 import os
 import sys
-import sqlite3
 import json
-import hashlib
 import hmac
 import base64
+import time
 from datetime import datetime
-from flask import Flask, send_from_directory, request, jsonify
+from flask import Blueprint, Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import requests
+from comparables import (
+    COMPARABLES_K, COMPARABLES_MAX_K, COMPARABLES_PRELOAD, find_comparables, index as comparables_index
+)
+from db import get_connection, init_database, pool as db_pool
+from ingest import INGEST_SYNC_DEFAULT, BufferFull, writer as simulation_writer
+from line_dispatch import LineDispatcher
+from line_events import EventDeduplicator, Outbox, text_events
+from line_webhook import LineWebhook, WebhookError
+from market_data import market_data
+from metrics import registry, timed
+from profiler import profiler
+from rollups import query_rollups
+from result_cache import ResultCache, canonical_key
+from simulation import (
+    ScenarioError, calculate_batch, calculate_scenario, get_scenario_table, load_ndjson, normalize_scenario, sweep_grid
+)
+from static_assets import StaticAssets
 
 # LINE設定（実際の値）
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', 'da9304a0ba9f50054710655d64a81680')
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '14e9b69b3cfdf71dd1298dfbe2bc4cae')
 LINE_CHANNEL_ID = os.environ.get('LINE_CHANNEL_ID', '2007761838')
 
-app = Flask(__name__, static_folder='static')
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your_secret_key_here')
+# エクスポートAPIのトークン（未設定の場合はエクスポート無効）
+EXPORT_TOKEN = os.environ.get('EXPORT_TOKEN', '')
+# /metrics の認証トークン（未設定なら認証なし）
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
-CORS(app)
+# 履歴APIの1ページの件数と、LINEの「履歴」で比較する件数
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+HISTORY_COMPARE_COUNT = int(os.environ.get('HISTORY_COMPARE_COUNT', '3'))
+
+# 一括計算APIで受け付ける最大シナリオ数
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '1000'))
+
+# Webhookの署名検証・解析
+line_webhook_receiver = LineWebhook(LINE_CHANNEL_SECRET)
+# LINE送信キュー
+line_dispatcher = LineDispatcher(LINE_CHANNEL_ACCESS_TOKEN)
+# ワーカーの終了時に送信待ちを送り切り、残りは未送信として記録
+atexit.register(line_dispatcher.close)
+# /metrics で集計する送信キュー（asgi.py は非同期版を追加する）
+line_dispatchers = [line_dispatcher]
+# 再送されたWebhookイベントの重複排除
+event_deduplicator = EventDeduplicator()
+
+# 計算結果キャッシュ（件数・TTLは環境変数で設定）
+simulation_cache = ResultCache()
+market_data.add_listener(simulation_cache.clear)
+
+# 保存した結果を類似シミュレーションの索引に追加
+simulation_writer.add_listener(comparables_index.add_saved)
+
+# 起動時にスキーマを作成・更新するか（マイグレーションを別の手順で実行する場合は0）
+INIT_DATABASE = os.environ.get('INIT_DATABASE', '1') == '1'
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# ルートはBlueprintに登録し、アプリは create_app() で作成する
+api = Blueprint('api', __name__)
+
+# 静的ファイルのETag・圧縮データ（create_app() で作成、ファイル更新時は作り直す）
+static_assets = StaticAssets(STATIC_FOLDER)
+
+# ルート別のリクエスト計測（/metrics で出力）
+request_seconds = registry.histogram(
+    'minpaku_http_request_duration_seconds',
+    'HTTP request latency by route',
+    ['route', 'method', 'status']
+)
+requests_in_flight = registry.gauge(
+    'minpaku_http_requests_in_flight',
+    'Requests currently being handled',
+    ['route']
+)
+
+@api.before_app_request
+def start_request_timer():
+    g.request_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.request_started = time.perf_counter()
+    requests_in_flight.inc(g.request_route)
+    profiler.begin(f'{request.method} {g.request_route}')
+
+@api.after_app_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@api.teardown_app_request
+def finish_request_timer(error=None):
+    route = g.pop('request_route', None)
+    if route is None:
+        return
+    elapsed = time.perf_counter() - g.request_started
+    requests_in_flight.dec(route)
+    request_seconds.observe(elapsed, route, request.method, g.get('response_status', 500))
+    profiler.end(elapsed * 1000)
+
+def dispatch_stats():
+    """登録されている送信キューのステータスコード別・結果別の件数と送信待ち件数の合計"""
+    status_codes = {}
+    outcomes = {}
+    pending = 0
+    for dispatcher in line_dispatchers:
+        for status, count in dispatcher.status_codes.items():
+            status_codes[status] = status_codes.get(status, 0) + count
+        for outcome, count in dispatcher.stats.items():
+            outcomes[outcome] = outcomes.get(outcome, 0) + count
+        pending += dispatcher.pending()
+    return status_codes, outcomes, pending
+
+def collect_stats():
+    """キャッシュ・接続プール・保存バッファ・LINE送信キューの統計を/metrics用に変換"""
+    cache = simulation_cache.stats()
+    ingest = simulation_writer.snapshot()
+    status_codes, outcomes, pending = dispatch_stats()
+    return [
+        ('minpaku_cache_requests_total', 'counter', 'Calculation cache lookups',
+         [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])]),
+        ('minpaku_cache_evictions_total', 'counter', 'Calculation cache evictions and expirations',
+         [({'reason': 'size'}, cache['evictions']), ({'reason': 'ttl'}, cache['expirations'])]),
+        ('minpaku_cache_entries', 'gauge', 'Calculation cache entries', [({}, cache['size'])]),
+        ('minpaku_db_connections_opened_total', 'counter', 'SQLite connections opened', [({}, db_pool.opened)]),
+        ('minpaku_db_connections_idle', 'gauge', 'Idle SQLite connections in the pool', [({}, db_pool.stats()['idle'])]),
+        ('minpaku_ingest_rows_total', 'counter', 'Saved simulations written',
+         [({'result': 'ok'}, ingest['rows'] - ingest['failedRows']), ({'result': 'failed'}, ingest['failedRows'])]),
+        ('minpaku_ingest_batches_total', 'counter', 'Group-commit batches written', [({}, ingest['batches'])]),
+        ('minpaku_ingest_pending', 'gauge', 'Saves waiting to be written', [({}, ingest['pending'])]),
+        ('minpaku_line_api_responses_total', 'counter', 'LINE API responses by status code',
+         [({'status': status}, count) for status, count in sorted(status_codes.items())]),
+        ('minpaku_line_messages_total', 'counter', 'LINE pushes by outcome',
+         [({'outcome': outcome}, count) for outcome, count in outcomes.items()]),
+        ('minpaku_line_queue_pending', 'gauge', 'LINE pushes waiting to be sent', [({}, pending)]),
+        ('minpaku_line_duplicate_events_total', 'counter', 'Redelivered webhook events skipped',
+         [({}, event_deduplicator.duplicates)]),
+        ('minpaku_comparables_rows', 'gauge', 'Saved simulations in the comparables index',
+         [({}, comparables_index.size)]),
+        ('minpaku_market_data_reloads_total', 'counter', 'Market data reloads', [({}, market_data.reloads)]),
+        ('minpaku_profiler_dumps_total', 'counter', 'Slow requests written by the profiler', [({}, profiler.dumped)])
+    ]
+
+registry.add_collector(collect_stats)
+
+# SQLは定数にして接続ごとのステートメントキャッシュで再利用する
+SELECT_LATEST_SQL = '''
+    SELECT s.* FROM latest_simulation AS l
+    JOIN simulations AS s ON s.id = l.simulation_id
+    WHERE l.user_id = ?
+'''
+
+# ユーザー別履歴（カバリングインデックスの列だけを読み、(created_at, id)でキーセットページング）
+HISTORY_COLUMNS = [
+    'id', 'created_at', 'region', 'property_type', 'minpaku_law', 'capacity',
+    'annual_profit', 'roi', 'recovery_period'
+]
+SELECT_HISTORY_SQL = f'''
+    SELECT {', '.join(HISTORY_COLUMNS)} FROM simulations
+    WHERE user_id = ?
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+'''
+SELECT_HISTORY_AFTER_SQL = f'''
+    SELECT {', '.join(HISTORY_COLUMNS)} FROM simulations
+    WHERE user_id = ? AND (created_at, id) < (?, ?)
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+'''
 
 def get_base_url():
     """動的にベースURLを取得"""
@@ -26,197 +183,243 @@ def get_base_url():
         return f"{request.scheme}://{request.host}"
     return "http://localhost:3000"  # フォールバック
 
-def init_database():
-    """データベースを初期化"""
-    # データベースディレクトリを作成
-    os.makedirs('database', exist_ok=True)
-    
-    conn = sqlite3.connect('database/simulations.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS simulations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            region TEXT,
-            operation_type TEXT,
-            property_type TEXT,
-            area INTEGER,
-            capacity INTEGER,
-            minpaku_law TEXT,
-            monthly_rent INTEGER,
-            purchase_price INTEGER,
-            renovation_cost INTEGER,
-            initial_cost INTEGER,
-            annual_revenue INTEGER,
-            annual_costs INTEGER,
-            annual_profit INTEGER,
-            roi REAL,
-            recovery_period REAL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-@app.route('/')
+@api.route('/')
 def index():
     """メインページを表示"""
-    return send_from_directory(app.static_folder, 'index.html')
+    return static_assets.response('index.html')
 
-@app.route('/<path:filename>')
+@api.route('/<path:filename>')
 def static_files(filename):
-    """静的ファイルを配信"""
-    return send_from_directory(app.static_folder, filename)
+    """静的ファイルを配信（ETag・圧縮・キャッシュヘッダー付き）"""
+    return static_assets.response(filename)
+
+# 配信中の係数表のファイル名（scenario-table.<版>.json）
+published_table = {'filename': None}
+
+def publish_scenario_table():
+    """係数表を版付きのJSONとして登録（市場データが更新されたら新しい版に差し替える）"""
+    version, document = get_scenario_table().document()
+    filename = f'scenario-table.{version}.json'
+    previous = published_table['filename']
+    if filename != previous:
+        static_assets.add(filename, document, 'application/json')
+        published_table['filename'] = filename
+        if previous:
+            static_assets.discard(previous)
+    return filename
+
+@api.route('/api/simulation/table', methods=['GET'])
+def scenario_table():
+    """画面の選択肢の組み合わせごとの係数表（フロントエンドの即時試算用）
+
+    毎回ETagで再検証する。Content-Locationの版付きURLは内容が変わらないので1年キャッシュできる。
+    """
+    filename = publish_scenario_table()
+    response = static_assets.response(filename)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Content-Location'] = f'/{filename}'
+    return response
+
+def run_calculation(data):
+    """計算APIの本体（同じ入力の計算結果はキャッシュから返す）"""
+    scenario = normalize_scenario(data)
+    cache_key = canonical_key(scenario)
+    result = simulation_cache.get(cache_key)
+    if result is None:
+        with timed('calculate'):
+            result = calculate_scenario(scenario)
+        simulation_cache.put(cache_key, result)
+    result = dict(result)
+    
+    # 確率的シミュレーション（指定時のみ。既定は決定論的な計算）
+    if data.get('mode') == 'montecarlo':
+        from risk import run_monte_carlo
+        
+        result['risk'] = run_monte_carlo(
+            result,
+            samples=data.get('samples'),
+            seed=data.get('seed'),
+            time_budget_ms=data.get('timeBudgetMs')
+        )
+    return result
 
-@app.route('/api/simulation/calculate', methods=['POST'])
+@api.route('/api/simulation/calculate', methods=['POST'])
 def calculate_simulation():
     """シミュレーション計算API"""
+    try:
+        with timed('json_parse'):
+            data = request.get_json()
+        
+        return jsonify(run_calculation(data))
+        
+    except ScenarioError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/simulation/calculate/batch', methods=['POST'])
+def calculate_simulation_batch():
+    """シミュレーション一括計算API（JSON配列またはNDJSON）"""
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            scenarios = load_ndjson(request.stream)
+        else:
+            data = request.get_json()
+            scenarios = data.get('scenarios') if isinstance(data, dict) else data
+            if not isinstance(scenarios, list):
+                return jsonify({'error': 'Expected an array of scenarios'}), 400
+        
+        if len(scenarios) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'Too many scenarios (max {MAX_BATCH_SIZE})'}), 413
+        
+        with timed('calculate'):
+            results, errors = calculate_batch(scenarios)
+        
+        return jsonify({
+            'count': len(results),
+            'succeeded': len(results) - len(errors),
+            'results': results,
+            'errors': errors
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/simulation/calculate/sweep', methods=['POST'])
+def calculate_simulation_sweep():
+    """感度分析API（各軸の組み合わせのROI・回収期間を一括計算）"""
     try:
         data = request.get_json()
         
-        # 入力データの検証
-        required_fields = ['region', 'operationType', 'propertyType', 'area', 'capacity', 'minpakuLaw']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
-        
-        # 計算ロジック
-        region = data['region']
-        operation_type = data['operationType']
-        property_type = data['propertyType']
-        area = int(data['area'])
-        capacity = int(data['capacity'])
-        minpaku_law = data['minpakuLaw']
-        
-        # 投資金額
-        monthly_rent = int(data.get('monthlyRent', 0))
-        purchase_price = int(data.get('purchasePrice', 0))
-        renovation_cost = int(data.get('renovationCost', 0))
-        initial_cost = int(data.get('initialCost', 0))
-        
-        # 地域別の基本データ
-        region_data = {
-            '東京都': {'daily_rate': 12000, 'occupancy': 0.75, 'expenses_rate': 0.35},
-            '大阪府': {'daily_rate': 8000, 'occupancy': 0.70, 'expenses_rate': 0.30},
-            '京都府': {'daily_rate': 10000, 'occupancy': 0.72, 'expenses_rate': 0.32},
-            '神奈川県': {'daily_rate': 9000, 'occupancy': 0.68, 'expenses_rate': 0.33},
-            '愛知県': {'daily_rate': 7000, 'occupancy': 0.65, 'expenses_rate': 0.28},
-            '福岡県': {'daily_rate': 6000, 'occupancy': 0.62, 'expenses_rate': 0.25}
-        }
+        grid = sweep_grid(
+            data.get('scenario'),
+            data.get('axes'),
+            metrics=data.get('metrics'),
+            max_points_per_axis=data.get('maxPointsPerAxis')
+        )
         
-        base_data = region_data.get(region, region_data['東京都'])
-        
-        # 収容人数による単価調整
-        capacity_multiplier = 1 + (capacity - 2) * 0.15
-        daily_rate = int(base_data['daily_rate'] * capacity_multiplier)
-        
-        # 民泊新法による営業日数制限
-        max_days = 180 if minpaku_law == '民泊新法対応（180日制限あり）' else 365
-        
-        # 年間収益計算
-        operating_days = int(max_days * base_data['occupancy'])
-        annual_revenue = daily_rate * operating_days
-        
-        # 年間費用計算
-        annual_expenses = int(annual_revenue * base_data['expenses_rate'])
-        if operation_type == '転貸':
-            annual_expenses += monthly_rent * 12
-        
-        # 年間利益
-        annual_profit = annual_revenue - annual_expenses
-        
-        # 総投資額
-        total_investment = purchase_price + renovation_cost + initial_cost
-        
-        # ROI計算
-        roi = (annual_profit / total_investment * 100) if total_investment > 0 else 0
-        
-        # 投資回収期間
-        recovery_period = (total_investment / annual_profit) if annual_profit > 0 else 999
-        
-        result = {
-            'region': region,
-            'operationType': operation_type,
-            'propertyType': property_type,
-            'area': area,
-            'capacity': capacity,
-            'minpakuLaw': minpaku_law,
-            'monthlyRent': monthly_rent,
-            'purchasePrice': purchase_price,
-            'renovationCost': renovation_cost,
-            'initialCost': initial_cost,
-            'dailyRate': daily_rate,
-            'operatingDays': operating_days,
-            'annualRevenue': annual_revenue,
-            'annualExpenses': annual_expenses,
-            'annualProfit': annual_profit,
-            'totalInvestment': total_investment,
-            'roi': round(roi, 2),
-            'recoveryPeriod': round(recovery_period, 1)
-        }
+        return jsonify(grid)
         
+    except ScenarioError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/simulation/projection', methods=['POST'])
+def simulation_projection():
+    """長期キャッシュフロー予測API（単一物件またはポートフォリオ）"""
+    from projection import normalize_assumptions, project_cash_flow, project_portfolio
+    
+    try:
+        data = request.get_json()
+        
+        assumptions = normalize_assumptions(data.get('assumptions'))
+        include_monthly = bool(data.get('includeMonthly', 'scenarios' not in data))
+        
+        if 'scenarios' in data:
+            scenarios = []
+            for index, item in enumerate(data['scenarios'] or []):
+                try:
+                    scenarios.append(normalize_scenario(item))
+                except ScenarioError as e:
+                    raise ScenarioError(f'Scenario {index}: {e}')
+            if len(scenarios) > MAX_BATCH_SIZE:
+                return jsonify({'error': f'Too many scenarios (max {MAX_BATCH_SIZE})'}), 413
+            return jsonify(project_portfolio(scenarios, assumptions, include_monthly))
+        
+        scenario = normalize_scenario(data.get('scenario'))
+        return jsonify(project_cash_flow(scenario, assumptions, include_monthly))
+        
+    except ScenarioError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/simulation/optimize', methods=['POST'])
+def optimize_simulation_portfolio():
+    """候補物件から予算・制約内で年間利益（またはROI）が最大になる組み合わせを選ぶ"""
+    from optimizer import MAX_OPTIMIZER_CANDIDATES, normalize_request, optimize_portfolio
+    
+    try:
+        optimization = normalize_request(request.get_json())
+        if len(optimization['candidates']) > MAX_OPTIMIZER_CANDIDATES:
+            return jsonify({'error': f'Too many candidates (max {MAX_OPTIMIZER_CANDIDATES})'}), 413
+        
+        with timed('optimize'):
+            result = optimize_portfolio(optimization)
         return jsonify(result)
         
+    except ScenarioError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/simulation/save', methods=['POST'])
+@api.route('/api/simulation/comparables', methods=['POST'])
+def simulation_comparables():
+    """条件の近い保存済みシミュレーションK件とROIの分布（試算結果のベンチマーク表示用）"""
+    try:
+        data = request.get_json()
+        scenario = normalize_scenario(data)
+        k = min(max(int(data.get('k') or COMPARABLES_K), 1), COMPARABLES_MAX_K)
+        
+        with timed('comparables'):
+            result = find_comparables(scenario, k)
+        return jsonify(result)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def save_params(data):
+    """保存APIの入力をINSERTのパラメーターに変換"""
+    return (
+        data.get('userId', 'anonymous'), data['region'], data['operationType'], data['propertyType'],
+        data['area'], data['capacity'], data['minpakuLaw'],
+        data.get('monthlyRent', 0), data.get('purchasePrice', 0),
+        data.get('renovationCost', 0), data.get('initialCost', 0),
+        data['annualRevenue'], data['annualExpenses'], data['annualProfit'],
+        data['roi'], data['recoveryPeriod']
+    )
+
+@api.route('/api/simulation/save', methods=['POST'])
 def save_simulation():
     """シミュレーション結果を保存"""
     try:
-        data = request.get_json()
-        user_id = data.get('userId', 'anonymous')
-        
-        conn = sqlite3.connect('database/simulations.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO simulations (
-                user_id, region, operation_type, property_type, area, capacity,
-                minpaku_law, monthly_rent, purchase_price, renovation_cost,
-                initial_cost, annual_revenue, annual_costs, annual_profit,
-                roi, recovery_period
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id, data['region'], data['operationType'], data['propertyType'],
-            data['area'], data['capacity'], data['minpakuLaw'],
-            data.get('monthlyRent', 0), data.get('purchasePrice', 0),
-            data.get('renovationCost', 0), data.get('initialCost', 0),
-            data['annualRevenue'], data['annualExpenses'], data['annualProfit'],
-            data['roi'], data['recoveryPeriod']
-        ))
-        
-        simulation_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with timed('json_parse'):
+            data = request.get_json()
+        params = save_params(data)
+        
+        # 書き込みはまとめてコミット（同期モードではコミット後のIDを返す）
+        sync = bool(data.get('sync', INGEST_SYNC_DEFAULT))
+        simulation_id = simulation_writer.submit(params, wait=sync)
+        if not sync:
+            return jsonify({'success': True, 'queued': True}), 202
         
         return jsonify({'success': True, 'simulationId': simulation_id})
         
+    except BufferFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/simulation/latest/<user_id>', methods=['GET'])
+def fetch_latest(user_id):
+    """ユーザーの最新のシミュレーション結果（なければNone）"""
+    with get_connection() as conn:
+        cursor = conn.execute(SELECT_LATEST_SQL, (user_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    columns = [description[0] for description in cursor.description]
+    return dict(zip(columns, row))
+
+@api.route('/api/simulation/latest/<user_id>', methods=['GET'])
 def get_latest_simulation(user_id):
     """最新のシミュレーション結果を取得"""
     try:
-        conn = sqlite3.connect('database/simulations.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM simulations 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC 
-            LIMIT 1
-        ''', (user_id,))
-        
-        row = cursor.fetchone()
-        conn.close()
+        result = fetch_latest(user_id)
         
-        if row:
-            columns = [description[0] for description in cursor.description]
-            result = dict(zip(columns, row))
+        if result:
             return jsonify(result)
         else:
             return jsonify({'error': 'No simulation found'}), 404
@@ -224,68 +427,175 @@ def get_latest_simulation(user_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def verify_line_signature(body, signature):
-    """LINE Webhook署名を検証"""
-    hash = hmac.new(
-        LINE_CHANNEL_SECRET.encode('utf-8'),
-        body.encode('utf-8'),
-        hashlib.sha256
-    ).digest()
-    return base64.b64encode(hash).decode('utf-8') == signature
+@api.route('/api/simulation/export', methods=['GET'])
+def export_simulations():
+    """保存済みシミュレーションをCSV/NDJSON/columnarでストリーミング出力"""
+    from export import EXPORT_FORMATS, ExportBusy, ExportStream, parse_filters
+    
+    try:
+        if not EXPORT_TOKEN:
+            return jsonify({'error': 'Export is disabled'}), 403
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {EXPORT_TOKEN}'):
+            return jsonify({'error': 'Unauthorized'}), 401
+        
+        export_format = request.args.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({'error': f'Unsupported export format: {export_format}'}), 400
+        
+        filters = parse_filters(
+            request.args.get('from'),
+            request.args.get('to'),
+            request.args.get('region'),
+            request.args.get('userId')
+        )
+        
+        extension = 'bin' if export_format == 'columnar' else export_format
+        return Response(
+            ExportStream(export_format, filters),
+            mimetype=EXPORT_FORMATS[export_format],
+            headers={'Content-Disposition': f'attachment; filename=simulations.{extension}'}
+        )
+        
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-def send_line_message(user_id, message):
-    """LINEメッセージを送信"""
-    url = 'https://api.line.me/v2/bot/message/push'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
-    }
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus形式の計測値（ルート・処理段階別の時間、キャッシュ・DB・LINE送信の件数）"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/simulation/ingest/stats', methods=['GET'])
+def ingest_stats():
+    """保存のグループコミットの統計（バッチサイズ・書き込み時間）"""
+    return jsonify(simulation_writer.snapshot())
+
+@api.route('/api/analytics/rollups', methods=['GET'])
+def analytics_rollups():
+    """地域×民泊法×運営形態（×日）別の件数・平均ROI・回収期間の中央値"""
+    try:
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        for value in (date_from, date_to):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+        
+        filters = {
+            'region': request.args.get('region'),
+            'minpaku_law': request.args.get('minpakuLaw'),
+            'operation_type': request.args.get('operationType')
+        }
+        by_day = request.args.get('groupBy', 'day') == 'day'
+        
+        with get_connection() as conn:
+            groups = query_rollups(conn, date_from, date_to, filters, by_day)
+        
+        return jsonify({'groups': groups})
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def encode_history_cursor(row):
+    """次ページのカーソル（最後の行の created_at と id）"""
+    return base64.urlsafe_b64encode(json.dumps([row[1], row[0]]).encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    try:
+        created_at, simulation_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return created_at, int(simulation_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+# 複数ユーザーの直近の履歴（ユーザーごとにLIMIT付きでインデックスを読み、UNION ALLで1回のクエリにする）
+SELECT_RECENT_HISTORY_SQL = f'''
+    SELECT * FROM (
+        SELECT user_id, {', '.join(HISTORY_COLUMNS)} FROM simulations
+        WHERE user_id = ?
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    )
+'''
+# 1回のクエリにまとめるユーザー数（SQLiteのUNIONの上限500より小さくする）
+RECENT_HISTORY_BATCH_SIZE = 100
+
+def fetch_history(user_id, limit, cursor=None):
+    """ユーザーの履歴を新しい順に1ページ分取得"""
+    with get_connection() as conn:
+        if cursor:
+            created_at, simulation_id = decode_history_cursor(cursor)
+            return conn.execute(SELECT_HISTORY_AFTER_SQL, (user_id, created_at, simulation_id, limit)).fetchall()
+        return conn.execute(SELECT_HISTORY_SQL, (user_id, limit)).fetchall()
+
+def fetch_recent_histories(user_ids, limit):
+    """複数ユーザーの直近limit件の履歴をまとめて取得（{userId: 新しい順の行}）"""
+    histories = {}
+    user_ids = list(user_ids)
+    with get_connection() as conn:
+        for start in range(0, len(user_ids), RECENT_HISTORY_BATCH_SIZE):
+            chunk = user_ids[start:start + RECENT_HISTORY_BATCH_SIZE]
+            sql = ' UNION ALL '.join([SELECT_RECENT_HISTORY_SQL] * len(chunk))
+            params = [value for user_id in chunk for value in (user_id, limit)]
+            for row in conn.execute(sql, params):
+                histories.setdefault(row[0], []).append(row[1:])
+    for rows in histories.values():
+        rows.sort(key=lambda row: (row[1], row[0]), reverse=True)
+    return histories
+
+def history_page(user_id, limit=None, cursor=None):
+    """履歴APIの1ページ分（次のページのカーソル付き）"""
+    limit = min(max(int(limit or HISTORY_PAGE_SIZE), 1), HISTORY_MAX_PAGE_SIZE)
     
-    data = {
-        'to': user_id,
-        'messages': [{'type': 'text', 'text': message}]
-    }
+    # 1件多く取得して次のページの有無を判定
+    rows = fetch_history(user_id, limit + 1, cursor)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
     
-    response = requests.post(url, headers=headers, json=data)
-    return response.status_code == 200
+    return {
+        'items': [dict(zip(HISTORY_COLUMNS, row)) for row in rows],
+        'nextCursor': encode_history_cursor(rows[-1]) if has_more else None
+    }
 
-@app.route('/api/line/webhook', methods=['POST'])
-def line_webhook():
-    """LINE Webhook エンドポイント"""
+@api.route('/api/simulation/history/<user_id>', methods=['GET'])
+def get_simulation_history(user_id):
+    """シミュレーション履歴を取得（cursorで次のページ）"""
     try:
-        # 署名検証
-        signature = request.headers.get('X-Line-Signature')
-        body = request.get_data(as_text=True)
-        
-        if not verify_line_signature(body, signature):
-            return 'Invalid signature', 400
-        
-        # イベント処理
-        events = json.loads(body).get('events', [])
-        
-        for event in events:
-            if event['type'] == 'message' and event['message']['type'] == 'text':
-                user_id = event['source']['userId']
-                message_text = event['message']['text'].strip()
-                
-                if message_text == '結果':
-                    # 最新のシミュレーション結果を取得
-                    conn = sqlite3.connect('database/simulations.db')
-                    cursor = conn.cursor()
-                    
-                    cursor.execute('''
-                        SELECT * FROM simulations 
-                        WHERE user_id = ? 
-                        ORDER BY created_at DESC 
-                        LIMIT 1
-                    ''', (user_id,))
-                    
-                    row = cursor.fetchone()
-                    conn.close()
-                    
-                    if row:
-                        # 結果メッセージを作成
-                        result_message = f"""🏠 民泊シミュレーション結果
+        return jsonify(history_page(user_id, request.args.get('limit'), request.args.get('cursor')))
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def send_line_message(user_id, message):
+    """LINEメッセージを送信キューに積む（送信・再送はバックグラウンドで実行）"""
+    return line_dispatcher.push(user_id, message)
+
+def fetch_latest_simulations(user_ids):
+    """複数ユーザーの最新シミュレーションをIN句でまとめて取得"""
+    rows = {}
+    user_ids = list(user_ids)
+    with get_connection() as conn:
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            for row in conn.execute(f"""
+                SELECT s.* FROM latest_simulation AS l
+                JOIN simulations AS s ON s.id = l.simulation_id
+                WHERE l.user_id IN ({placeholders})
+            """, chunk):
+                rows[row[1]] = row
+    return rows
+
+def format_simulation_message(row):
+    """保存済みシミュレーション行をLINEメッセージに整形"""
+    return f"""🏠 民泊シミュレーション結果
 
 📍 地域: {row[2]}
 🏢 運営形態: {row[3]}
@@ -310,30 +620,130 @@ def line_webhook():
 📅 計算日時: {row[17]}
 
 ※ この結果は概算です。実際の収益は市場状況により変動します。"""
-                        
-                        send_line_message(user_id, result_message)
-                    else:
-                        send_line_message(user_id, "シミュレーション結果が見つかりません。まずはWebサイトでシミュレーションを実行してください。\n\n🌐 https://prorium.github.io/arikon-minpaku/")
-                
-                elif message_text in ['シミュレーション', 'シミュレーター', 'sim']:
-                    send_line_message(user_id, "民泊シミュレーターはこちらからご利用ください！\n\n🌐 https://prorium.github.io/arikon-minpaku/\n\nシミュレーション完了後、「結果」とメッセージを送信すると詳細な結果をお送りします。")
-                
-                else:
-                    send_line_message(user_id, "こんにちは！有村昆の民泊塾です。\n\n以下のコマンドをお試しください：\n・「結果」- 最新のシミュレーション結果を表示\n・「シミュレーション」- シミュレーターのURLを表示\n\n🌐 https://prorium.github.io/arikon-minpaku/")
+
+def format_history_message(rows):
+    """直近の履歴を、前回からの変化つきで簡潔に整形"""
+    lines = [f"📈 直近{len(rows)}件のシミュレーション"]
+    for number, row in enumerate(rows):
+        simulation_id, created_at, region, property_type, minpaku_law, capacity, annual_profit, roi, recovery_period = row
+        lines.append("")
+        lines.append(f"{number + 1}. {created_at[:10] if created_at else ''} {region} {property_type} {capacity}名")
+        lines.append(f"   利益 {annual_profit:,}円 / ROI {roi}% / 回収 {recovery_period}年")
+        
+        # ひとつ前の実行との差分
+        if number + 1 < len(rows):
+            previous = rows[number + 1]
+            changes = []
+            if (region, property_type, minpaku_law, capacity) != tuple(previous[2:6]):
+                changes.append("条件変更")
+            try:
+                changes.append(f"利益 {annual_profit - previous[6]:+,}円")
+                changes.append(f"ROI {roi - previous[7]:+.1f}pt")
+            except TypeError:
+                pass
+            if changes:
+                lines.append(f"   前回比: {' / '.join(changes)}")
+    return "\n".join(lines)
+
+def build_replies(messages):
+    """(userId, テキスト) の一覧から返信を作成（DB参照あり）"""
+    # 「結果」の最新結果・「履歴」の直近の履歴は、それぞれ1回のクエリでまとめて取得
+    result_users = {user_id for user_id, text in messages if text == '結果'}
+    latest_rows = fetch_latest_simulations(result_users) if result_users else {}
+    history_users = {user_id for user_id, text in messages if text == '履歴'}
+    history_rows = fetch_recent_histories(history_users, HISTORY_COMPARE_COUNT) if history_users else {}
+    
+    # 同じユーザーへの返信は1回のpushにまとめる
+    outbox = Outbox()
+    for user_id, message_text in messages:
+        if message_text == '結果':
+            row = latest_rows.get(user_id)
+            if row:
+                outbox.add(user_id, format_simulation_message(row))
+            else:
+                outbox.add(user_id, "シミュレーション結果が見つかりません。まずはWebサイトでシミュレーションを実行してください。\n\n🌐 https://prorium.github.io/arikon-minpaku/")
+        
+        elif message_text == '履歴':
+            rows = history_rows.get(user_id)
+            if rows:
+                outbox.add(user_id, format_history_message(rows))
+            else:
+                outbox.add(user_id, "シミュレーション履歴がありません。まずはWebサイトでシミュレーションを実行してください。\n\n🌐 https://prorium.github.io/arikon-minpaku/")
+        
+        elif message_text in ['シミュレーション', 'シミュレーター', 'sim']:
+            outbox.add(user_id, "民泊シミュレーターはこちらからご利用ください！\n\n🌐 https://prorium.github.io/arikon-minpaku/\n\nシミュレーション完了後、「結果」とメッセージを送信すると詳細な結果をお送りします。")
+        
+        else:
+            outbox.add(user_id, "こんにちは！有村昆の民泊塾です。\n\n以下のコマンドをお試しください：\n・「結果」- 最新のシミュレーション結果を表示\n・「履歴」- 直近のシミュレーションを比較\n・「シミュレーション」- シミュレーターのURLを表示\n\n🌐 https://prorium.github.io/arikon-minpaku/")
+    return outbox
+
+@api.route('/api/line/webhook', methods=['POST'])
+def line_webhook():
+    """LINE Webhook エンドポイント"""
+    try:
+        # 受信したバイト列のまま署名を検証し、JSONは1回だけ解析
+        line_webhook_receiver.check_length(request.content_length)
+        body = request.stream.read(line_webhook_receiver.max_bytes + 1)
+        events = line_webhook_receiver.parse(body, request.headers.get('X-Line-Signature'))
+        
+        # イベント処理（再送されたイベントは除外。途中で失敗したら再送を受け付ける）
+        with event_deduplicator.claim() as claimed:
+            messages = list(text_events(events, claimed))
+            
+            outbox = build_replies(messages)
+            
+            for user_id, user_messages in outbox.pushes():
+                send_line_message(user_id, user_messages)
         
         return 'OK', 200
         
+    except WebhookError as e:
+        return str(e), e.status
     except Exception as e:
         print(f"Webhook error: {e}")
         return 'Error', 500
 
-@app.route('/api/line/webhook', methods=['GET'])
+@api.route('/api/line/webhook', methods=['GET'])
 def line_webhook_verify():
     """LINE Webhook 検証用エンドポイント"""
     return 'LINE Webhook is working!', 200
 
+def create_app():
+    """アプリを作成し、共有できるデータを読み込む
+
+    gunicorn --preload（gunicorn.conf.py）ではマスタープロセスで1回だけ実行され、
+    市場データ・係数表・静的ファイルの圧縮データ・類似検索の索引はワーカーとコピーオンライトで共有される。
+    DB接続・LINE送信・保存のスレッドはfork後の初回利用時に各ワーカーで作成する。
+    """
+    app = Flask(__name__, static_folder='static')
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your_secret_key_here')
+    
+    CORS(app)
+    app.register_blueprint(api)
+    
+    static_assets.warm()
+    publish_scenario_table()
+    if INIT_DATABASE:
+        init_database()
+    if COMPARABLES_PRELOAD:
+        comparables_index.refresh()
+    if INIT_DATABASE or COMPARABLES_PRELOAD:
+        # マイグレーション・索引の作成で使った接続をfork先に持ち込まない
+        db_pool.close_all()
+    return app
+
+_app = None
+
+def __getattr__(name):
+    """main.app は初回参照時に作成（gunicorn main:app・asgi.py から使う）"""
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if __name__ == '__main__':
-    init_database()
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    create_app().run(host='0.0.0.0', port=port, debug=True)
 
@@ -0,0 +1,156 @@
+"""地域別の市場データ（単価・稼働率・経費率・ばらつき・季節係数）
+
+MARKET_DATA_PATH のJSONまたはCSVを読み込み、不変の索引を作って共有する。
+ファイルが更新されると次の参照時に読み直し、索引を丸ごと差し替える。
+
+CSVの列: region, ward, alias, dailyRate, occupancy, expensesRate,
+         occupancySd, rateSd, expensesSd, seasonality（12個を ; 区切り）
+"""
+import csv
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+MARKET_DATA_PATH = os.environ.get(
+    'MARKET_DATA_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'market_data.json')
+)
+# ファイル更新の確認間隔（秒）
+MARKET_DATA_CHECK_INTERVAL = float(os.environ.get('MARKET_DATA_CHECK_INTERVAL', '5'))
+
+MarketRates = namedtuple('MarketRates', [
+    'region', 'ward', 'daily_rate', 'occupancy', 'expenses_rate',
+    'occupancy_sd', 'rate_sd', 'expenses_sd', 'seasonality'
+])
+
+_FLAT_SEASONALITY = (1.0,) * 12
+
+
+class MarketTable:
+    """読み込み済みの市場データの不変な索引"""
+
+    def __init__(self, areas, default_region, version=None):
+        index = {}
+        aliases = {}
+        for area in areas:
+            rates = _to_rates(area)
+            index[(rates.region, rates.ward)] = rates
+            if area.get('alias') and not rates.ward:
+                aliases[area['alias']] = rates.region
+
+        if (default_region, None) not in index:
+            raise ValueError(f'Default region not found in market data: {default_region}')
+
+        self.version = version
+        self.default_region = default_region
+        self._index = MappingProxyType(index)
+        self._aliases = MappingProxyType(aliases)
+        self.regions = tuple(region for region, ward in index if ward is None)
+        self.areas = tuple(index.values())
+
+    @property
+    def aliases(self):
+        """別名（tokyo など）から都道府県名への対応"""
+        return self._aliases
+
+    def get(self, region, ward=None):
+        """区・市があればその値、なければ都道府県の値（見つからなければNone）"""
+        region = self._aliases.get(region, region)
+        if ward:
+            rates = self._index.get((region, ward))
+            if rates is not None:
+                return rates
+        return self._index.get((region, None))
+
+    def lookup(self, region, ward=None):
+        """getと同じだが、見つからない地域は既定の地域の値を返す"""
+        return self.get(region, ward) or self._index[(self.default_region, None)]
+
+    def __len__(self):
+        return len(self._index)
+
+
+def _to_rates(area):
+    seasonality = area.get('seasonality') or _FLAT_SEASONALITY
+    if isinstance(seasonality, str):
+        seasonality = seasonality.split(';')
+    seasonality = tuple(float(value) for value in seasonality)
+    if len(seasonality) != 12:
+        raise ValueError(f"Seasonality must have 12 values: {area.get('region')}")
+
+    return MarketRates(
+        region=area['region'],
+        ward=area.get('ward') or None,
+        daily_rate=float(area['dailyRate']),
+        occupancy=float(area['occupancy']),
+        expenses_rate=float(area['expensesRate']),
+        occupancy_sd=float(area.get('occupancySd') or 0),
+        rate_sd=float(area.get('rateSd') or 0),
+        expenses_sd=float(area.get('expensesSd') or 0),
+        seasonality=seasonality
+    )
+
+
+def load_table(path):
+    """JSONまたはCSVファイルから索引を作成"""
+    if path.endswith('.csv'):
+        with open(path, encoding='utf-8', newline='') as f:
+            areas = list(csv.DictReader(f))
+        default_region = areas[0]['region'] if areas else None
+        return MarketTable(areas, default_region)
+
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return MarketTable(data['areas'], data['defaultRegion'], data.get('version'))
+
+
+class MarketData:
+    """現在の索引を保持し、ファイル更新時に差し替える"""
+
+    def __init__(self, path=MARKET_DATA_PATH, check_interval=MARKET_DATA_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._table = load_table(path)
+        self._next_check = time.monotonic() + check_interval
+
+    def add_listener(self, callback):
+        """差し替え時に呼ぶ関数を登録（計算結果キャッシュの破棄など）"""
+        self._listeners.append(callback)
+
+    def table(self):
+        """現在の索引（確認間隔ごとにファイルの更新を確認）"""
+        if time.monotonic() >= self._next_check:
+            self._maybe_reload()
+        return self._table
+
+    def _maybe_reload(self):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self._mtime:
+                # 読み込みに失敗した場合は古い索引を使い続ける
+                self._table = load_table(self.path)
+                self._mtime = mtime
+                self.reloads += 1
+                for callback in self._listeners:
+                    callback()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Market data reload error: {e}")
+        finally:
+            self._lock.release()
+
+
+market_data = MarketData()
+
+
+def get_market_table():
+    return market_data.table()
@@ -0,0 +1,455 @@
+"""予算内で年間利益（またはポートフォリオROI）が最大になる物件の組み合わせを選ぶ
+
+候補が OPTIMIZER_EXACT_MAX 件以下なら分枝限定法で厳密に解き、それより多い場合は
+貪欲法と入れ替えによる局所探索で近似する。どちらも制限時間で打ち切り、
+それまでに見つかった最良の組み合わせを返す。
+ROIの最大化は「利益 - λ×投資額」の最大化を λ を更新しながら繰り返して解く（Dinkelbach法）。
+"""
+import os
+import time
+
+from market_data import get_market_table
+from simulation import SHINPO_LAW, ScenarioError, calculate_batch
+
+OPTIMIZER_TIME_LIMIT_MS = int(os.environ.get('OPTIMIZER_TIME_LIMIT_MS', '2000'))
+OPTIMIZER_MAX_TIME_LIMIT_MS = int(os.environ.get('OPTIMIZER_MAX_TIME_LIMIT_MS', '10000'))
+MAX_OPTIMIZER_CANDIDATES = int(os.environ.get('MAX_OPTIMIZER_CANDIDATES', '1000'))
+# これ以下の候補数は分枝限定法で厳密に解く
+EXACT_MAX_CANDIDATES = int(os.environ.get('OPTIMIZER_EXACT_MAX', '32'))
+
+OBJECTIVES = ('profit', 'roi')
+# 制限時間のうち最適化に使う割合（残りで除外した候補の限界価値を計算）
+SOLVE_TIME_SHARE = 0.7
+DINKELBACH_MAX_ITERATIONS = 30
+EPSILON = 1e-6
+
+
+class _Problem:
+    """候補の投資額・属性と制約"""
+
+    def __init__(self, weights, shinpo, regions, budget, max_shinpo=None, max_properties=None, min_regions=0,
+                 eligible=None):
+        self.weights = weights
+        self.shinpo = shinpo
+        self.regions = regions
+        self.budget = budget
+        self.max_shinpo = len(weights) if max_shinpo is None else max_shinpo
+        self.max_properties = len(weights) if max_properties is None else max_properties
+        self.min_regions = min_regions
+        self.eligible = [True] * len(weights) if eligible is None else eligible
+
+    def __len__(self):
+        return len(self.weights)
+
+    def can_include(self, index):
+        """単独で組み合わせに入れられるか"""
+        return (self.eligible[index] and self.weights[index] <= self.budget and self.max_properties > 0
+                and (not self.shinpo[index] or self.max_shinpo > 0))
+
+
+class _Selection:
+    """選択中の物件と、制約の判定に使う集計値"""
+
+    def __init__(self, problem, indices=()):
+        self.problem = problem
+        self.chosen = set()
+        self.weight = 0
+        self.shinpo = 0
+        self.region_counts = {}
+        for index in indices:
+            self.add(index)
+
+    def add(self, index):
+        p = self.problem
+        self.chosen.add(index)
+        self.weight += p.weights[index]
+        self.shinpo += p.shinpo[index]
+        self.region_counts[p.regions[index]] = self.region_counts.get(p.regions[index], 0) + 1
+
+    def remove(self, index):
+        p = self.problem
+        self.chosen.discard(index)
+        self.weight -= p.weights[index]
+        self.shinpo -= p.shinpo[index]
+        region = p.regions[index]
+        self.region_counts[region] -= 1
+        if not self.region_counts[region]:
+            del self.region_counts[region]
+
+    def within_limits(self):
+        """予算・民泊新法の件数・物件数の上限を守っているか"""
+        p = self.problem
+        return self.weight <= p.budget and self.shinpo <= p.max_shinpo and len(self.chosen) <= p.max_properties
+
+    def can_add(self, index):
+        p = self.problem
+        return (p.eligible[index] and self.weight + p.weights[index] <= p.budget
+                and self.shinpo + p.shinpo[index] <= p.max_shinpo
+                and len(self.chosen) < p.max_properties)
+
+    def can_remove(self, index):
+        p = self.problem
+        lost = self.region_counts[p.regions[index]] == 1
+        return len(self.region_counts) - lost >= p.min_regions
+
+    def can_swap(self, out, into):
+        p = self.problem
+        if not p.eligible[into] or self.weight - p.weights[out] + p.weights[into] > p.budget:
+            return False
+        if self.shinpo - p.shinpo[out] + p.shinpo[into] > p.max_shinpo:
+            return False
+        region_out, region_in = p.regions[out], p.regions[into]
+        if region_out == region_in:
+            return True
+        distinct = len(self.region_counts) - (self.region_counts[region_out] == 1) + (region_in not in self.region_counts)
+        return distinct >= p.min_regions
+
+
+def _density(problem, values, index):
+    weight = problem.weights[index]
+    if weight > 0:
+        return values[index] / weight
+    return float('inf') if values[index] > 0 else float('-inf')
+
+
+def _local_search(problem, values, forced, deadline, start=None):
+    """貪欲法で初期解を作り、追加・削除・入れ替えで改善（制約を満たせなければNone）"""
+    def density(index):
+        return _density(problem, values, index)
+
+    if start is not None and not forced <= set(start):
+        start = None
+    selection = _Selection(problem, forced if start is None else start)
+    # 上限を超えていれば、密度の低い候補から（なるべく地域を減らさないように）外す
+    removable = sorted(selection.chosen - forced, key=density)
+    while not selection.within_limits():
+        if selection.shinpo > problem.max_shinpo:
+            options = [index for index in removable if problem.shinpo[index]]
+        else:
+            options = removable
+        if not options:
+            return None
+        out = next((index for index in options if selection.can_remove(index)), options[0])
+        selection.remove(out)
+        removable.remove(out)
+
+    # 地域の分散: まだ選んでいない地域から1件ずつ追加（予算・件数を残すため安い候補を優先し、
+    # 価値は後の入れ替えで上げる）
+    while len(selection.region_counts) < problem.min_regions:
+        options = [
+            index for index in range(len(problem))
+            if problem.regions[index] not in selection.region_counts and selection.can_add(index)
+        ]
+        if not options:
+            # 渡された解から直せない場合は、必須の候補だけから作り直す
+            return _local_search(problem, values, forced, deadline) if start is not None else None
+        selection.add(min(options, key=lambda index: (problem.shinpo[index], problem.weights[index], -values[index])))
+    for index in sorted(range(len(problem)), key=density, reverse=True):
+        if values[index] > 0 and index not in selection.chosen and selection.can_add(index):
+            selection.add(index)
+
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        excluded = sorted(set(range(len(problem))) - selection.chosen, key=values.__getitem__, reverse=True)
+        for index in excluded:
+            if values[index] > 0 and selection.can_add(index):
+                selection.add(index)
+                improved = True
+        for index in list(selection.chosen - forced):
+            if values[index] < 0 and selection.can_remove(index):
+                selection.remove(index)
+                improved = True
+
+        removable = sorted(selection.chosen - forced, key=values.__getitem__)
+        for into in excluded:
+            if into in selection.chosen:
+                continue
+            for out in removable:
+                if values[into] - values[out] <= EPSILON:
+                    break
+                if selection.can_swap(out, into):
+                    selection.remove(out)
+                    selection.add(into)
+                    improved = True
+                    break
+            if improved or time.monotonic() >= deadline:
+                break
+    return sorted(selection.chosen)
+
+
+def _branch_and_bound(problem, values, forced, incumbent, deadline):
+    """分枝限定法で厳密解を探す。(選択, 探索を完了したか) を返す"""
+    selection = _Selection(problem, forced)
+    if not selection.within_limits():
+        return None, True
+    order = sorted(
+        (index for index in range(len(problem)) if index not in forced and problem.eligible[index]),
+        key=lambda index: _density(problem, values, index),
+        reverse=True
+    )
+    # 位置以降の候補で増やせる地域
+    suffix_regions = [set() for _ in range(len(order) + 1)]
+    for position in range(len(order) - 1, -1, -1):
+        suffix_regions[position] = suffix_regions[position + 1] | {problem.regions[order[position]]}
+
+    best = {'value': float('-inf'), 'chosen': None}
+    if incumbent is not None:
+        best['value'] = sum(values[index] for index in incumbent)
+        best['chosen'] = list(incumbent)
+    state = {'nodes': 0, 'timedOut': False}
+    current = list(forced)
+
+    def bound(position, capacity):
+        # 分数ナップサック（件数・地域の制約を外した緩和問題）の上界
+        total = 0
+        for index in order[position:]:
+            value = values[index]
+            if value <= 0:
+                break
+            weight = problem.weights[index]
+            if weight <= capacity:
+                capacity -= weight
+                total += value
+            else:
+                total += value * capacity / weight
+                break
+        return total
+
+    def search(position, value):
+        state['nodes'] += 1
+        if state['nodes'] % 1024 == 0 and time.monotonic() > deadline:
+            state['timedOut'] = True
+        if state['timedOut']:
+            return
+        if len(selection.region_counts) >= problem.min_regions and value > best['value'] + EPSILON:
+            best['value'] = value
+            best['chosen'] = sorted(current)
+        if position == len(order):
+            return
+        if value + bound(position, problem.budget - selection.weight) <= best['value'] + EPSILON:
+            return
+        if len(selection.region_counts.keys() | suffix_regions[position]) < problem.min_regions:
+            return
+
+        index = order[position]
+        if selection.can_add(index):
+            selection.add(index)
+            current.append(index)
+            search(position + 1, value + values[index])
+            current.pop()
+            selection.remove(index)
+        search(position + 1, value)
+
+    search(0, sum(values[index] for index in forced))
+    return best['chosen'], not state['timedOut']
+
+
+def _maximize(problem, values, forced, deadline, exact, start=None):
+    """制約内で values の合計を最大化。(選択, 最適か) を返す"""
+    chosen = _local_search(problem, values, forced, deadline, start)
+    if not exact:
+        return chosen, False
+    return _branch_and_bound(problem, values, forced, chosen, deadline)
+
+
+def _objective(profits, weights, chosen, objective):
+    profit = sum(profits[index] for index in chosen)
+    if objective == 'profit':
+        return profit
+    investment = sum(weights[index] for index in chosen)
+    return profit / investment * 100 if investment > 0 else 0
+
+
+def _solve(problem, profits, objective, forced, deadline, exact, start=None):
+    """目的関数を最大化する選択。(選択, 目的関数の値, 最適か) を返す（解なしは選択がNone）"""
+    if objective == 'profit':
+        chosen, optimal = _maximize(problem, profits, forced, deadline, exact, start)
+        if chosen is None:
+            return None, None, optimal
+        return chosen, _objective(profits, problem.weights, chosen, objective), optimal
+
+    # Dinkelbach法: 現在のROIを λ として 利益 - λ×投資額 を最大化し、改善がなくなるまで繰り返す
+    best, best_value, ratio = None, None, 0.0
+    optimal = False
+    for _ in range(DINKELBACH_MAX_ITERATIONS):
+        values = [profit - ratio * weight for profit, weight in zip(profits, problem.weights)]
+        chosen, optimal = _maximize(problem, values, forced, deadline, exact, best if best is not None else start)
+        if chosen is None:
+            break
+        value = _objective(profits, problem.weights, chosen, objective)
+        if best is not None and value <= best_value + EPSILON:
+            break
+        best, best_value, ratio = chosen, value, value / 100
+        if time.monotonic() >= deadline:
+            optimal = False
+            break
+    else:
+        optimal = False
+    return best, best_value, optimal and best is not None
+
+
+def normalize_request(data):
+    """最適化の条件を検証（予算・目的関数・制約・制限時間）"""
+    if not isinstance(data, dict):
+        raise ScenarioError('Request must be a JSON object')
+    candidates = data.get('candidates')
+    if not isinstance(candidates, list) or not candidates:
+        raise ScenarioError('At least one candidate is required')
+
+    objective = data.get('objective', 'profit')
+    if objective not in OBJECTIVES:
+        raise ScenarioError(f'Unsupported objective: {objective}')
+
+    constraints = data.get('constraints') or {}
+    if not isinstance(constraints, dict):
+        raise ScenarioError('constraints must be a JSON object')
+    try:
+        budget = int(data['budget'])
+        max_shinpo = constraints.get('maxShinpo')
+        max_shinpo = int(max_shinpo) if max_shinpo is not None else None
+        max_properties = constraints.get('maxProperties')
+        max_properties = int(max_properties) if max_properties is not None else None
+        min_regions = int(constraints.get('minRegions', 0))
+        time_limit_ms = int(data.get('timeLimitMs', OPTIMIZER_TIME_LIMIT_MS))
+    except KeyError:
+        raise ScenarioError('Missing required field: budget')
+    except (TypeError, ValueError):
+        raise ScenarioError('Invalid optimizer constraints')
+
+    if budget < 0 or min_regions < 0 or (max_shinpo is not None and max_shinpo < 0):
+        raise ScenarioError('budget and constraints must not be negative')
+    if max_properties is not None and max_properties < 1:
+        raise ScenarioError('maxProperties must be positive')
+    if not 1 <= time_limit_ms <= OPTIMIZER_MAX_TIME_LIMIT_MS:
+        raise ScenarioError(f'timeLimitMs must be between 1 and {OPTIMIZER_MAX_TIME_LIMIT_MS}')
+
+    return {
+        'candidates': candidates,
+        'objective': objective,
+        'budget': budget,
+        'maxShinpo': max_shinpo,
+        'maxProperties': max_properties,
+        'minRegions': min_regions,
+        'timeLimitMs': time_limit_ms
+    }
+
+
+def _candidate_summary(index, result):
+    return {
+        'index': index,
+        'region': result['region'],
+        'minpakuLaw': result['minpakuLaw'],
+        'annualProfit': result['annualProfit'],
+        'totalInvestment': result['totalInvestment'],
+        'roi': result['roi']
+    }
+
+
+def optimize_portfolio(request):
+    """候補から予算・制約内で最良の組み合わせを選び、除外した候補の限界価値を返す
+
+    限界価値は、その候補を必ず含めて解き直したときの目的関数の変化
+    （年間利益なら円、ROIならポイント。0に近いほど採用に近い）。
+    """
+    started = time.monotonic()
+    deadline = started + request['timeLimitMs'] / 1000
+    solve_deadline = started + request['timeLimitMs'] / 1000 * SOLVE_TIME_SHARE
+
+    results, errors = calculate_batch(request['candidates'])
+    if errors:
+        raise ScenarioError(f"Candidate {errors[0]['index']}: {errors[0]['error']}")
+
+    profits = [result['annualProfit'] for result in results]
+    # 別名（tokyo など）と都道府県名を同じ地域として数える
+    aliases = get_market_table().aliases
+    problem = _Problem(
+        [result['totalInvestment'] for result in results],
+        [result['minpakuLaw'] == SHINPO_LAW for result in results],
+        [aliases.get(result['region'], result['region']) for result in results],
+        request['budget'],
+        request['maxShinpo'],
+        request['maxProperties'],
+        request['minRegions'],
+        # 投資額0の物件はROIが定義できない（計算APIでも0）ため、ROIの最大化では選ばない
+        [result['totalInvestment'] > 0 for result in results] if request['objective'] == 'roi' else None
+    )
+    objective = request['objective']
+    exact = len(problem) <= EXACT_MAX_CANDIDATES
+
+    chosen, value, optimal = _solve(problem, profits, objective, set(), solve_deadline, exact)
+    if chosen is None:
+        return {
+            'objective': objective,
+            'method': 'branch_and_bound' if exact else 'heuristic',
+            'feasible': False,
+            'optimal': optimal,
+            'elapsedMs': round((time.monotonic() - started) * 1000, 1)
+        }
+
+    # 除外した候補を1件ずつ必ず含めて解き直す（より良い組み合わせが見つかれば差し替えてやり直す）
+    while True:
+        excluded = [index for index in range(len(problem)) if index not in chosen]
+        marginals = {}
+        marginals_complete = True
+        replaced = False
+        for position, index in enumerate(excluded):
+            if not problem.can_include(index):
+                marginals[index] = None
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                marginals_complete = False
+                break
+            forced_deadline = time.monotonic() + remaining / (len(excluded) - position)
+            forced_chosen, forced_value, forced_optimal = _solve(
+                problem, profits, objective, {index}, forced_deadline, exact, chosen + [index]
+            )
+            marginals_complete = marginals_complete and forced_optimal
+            if forced_chosen is None:
+                marginals[index] = None
+            elif forced_value > value + EPSILON:
+                chosen, value, optimal = forced_chosen, forced_value, False
+                replaced = True
+                break
+            else:
+                marginals[index] = forced_value - value
+        if not replaced:
+            break
+
+    selected = set(chosen)
+    investment = sum(problem.weights[index] for index in chosen)
+    profit = sum(profits[index] for index in chosen)
+    excluded = []
+    for index, result in enumerate(results):
+        if index in selected:
+            continue
+        summary = _candidate_summary(index, result)
+        if index in marginals:
+            marginal = marginals[index]
+            summary['marginalValue'] = round(marginal, 2) if marginal is not None else None
+        else:
+            summary['marginalValue'] = None
+        excluded.append(summary)
+
+    return {
+        'objective': objective,
+        'method': 'branch_and_bound' if exact else 'heuristic',
+        'feasible': True,
+        'optimal': optimal,
+        # 時間切れで計算できなかった候補がある場合はFalse（その候補の marginalValue はNone）
+        'marginalValuesComplete': len(marginals) == len(excluded),
+        'marginalValuesExact': exact and marginals_complete and len(marginals) == len(excluded),
+        'elapsedMs': round((time.monotonic() - started) * 1000, 1),
+        'portfolio': {
+            'count': len(chosen),
+            'totalInvestment': investment,
+            'annualProfit': profit,
+            'roi': round(profit / investment * 100, 2) if investment > 0 else 0,
+            'regions': sorted({problem.regions[index] for index in selected}),
+            'shinpoCount': sum(problem.shinpo[index] for index in chosen),
+            'budgetRemaining': problem.budget - investment
+        },
+        'selected': [_candidate_summary(index, results[index]) for index in chosen],
+        'excluded': excluded
+    }
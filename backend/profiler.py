@@ -0,0 +1,108 @@
+"""遅いリクエストのスタックを採取するサンプリングプロファイラー（既定は無効）
+
+PROFILE_SLOW_MS を設定すると、リクエスト処理中のスレッドのスタックを
+PROFILE_INTERVAL_MS ごとに採取する。処理時間が PROFILE_SLOW_MS を超えたリクエストの分だけ、
+flamegraph.pl や speedscope で読める折り畳み形式（"ルート;フレーム;... 回数"）で
+PROFILE_OUTPUT に追記する。
+
+    flamegraph.pl database/slow_requests.folded > slow.svg
+"""
+import os
+import sys
+import threading
+import time
+
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_OUTPUT = os.environ.get('PROFILE_OUTPUT', 'database/slow_requests.folded')
+# 1リクエストで保持する異なるスタックの上限
+MAX_STACKS_PER_REQUEST = 1000
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class _Profile:
+    __slots__ = ('label', 'stacks')
+
+    def __init__(self, label):
+        self.label = label
+        self.stacks = {}
+
+
+class SlowRequestProfiler:
+    def __init__(self, slow_ms=PROFILE_SLOW_MS, interval_ms=PROFILE_INTERVAL_MS, output_path=PROFILE_OUTPUT):
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000
+        self.output_path = output_path
+        self.dumped = 0
+        self._active = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.slow_ms > 0
+
+    def _start(self):
+        """採取スレッドを初回利用時（fork後）に起動"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._active = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def begin(self, label):
+        """現在のスレッドの採取を開始"""
+        if not self.enabled:
+            return
+        self._start()
+        with self._lock:
+            self._active[threading.get_ident()] = _Profile(label)
+
+    def end(self, duration_ms):
+        """採取を終え、遅かった場合はスタックを書き出す"""
+        if not self.enabled:
+            return
+        with self._lock:
+            profile = self._active.pop(threading.get_ident(), None)
+        if profile is None or duration_ms < self.slow_ms or not profile.stacks:
+            return
+
+        lines = [f'{profile.label};{stack} {count}\n' for stack, count in profile.stacks.items()]
+        try:
+            directory = os.path.dirname(self.output_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._lock, open(self.output_path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                self.dumped += 1
+        except OSError as e:
+            print(f"Profiler write error: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, profile in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = _collapse(frame)
+                    if stack in profile.stacks or len(profile.stacks) < MAX_STACKS_PER_REQUEST:
+                        profile.stacks[stack] = profile.stacks.get(stack, 0) + 1
+
+
+profiler = SlowRequestProfiler()
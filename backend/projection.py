@@ -0,0 +1,177 @@
+from functools import lru_cache
+
+from market_data import get_market_table
+from simulation import SUBLEASE, ScenarioError, build_columns, calculate_columns
+
+MIN_YEARS = 1
+MAX_YEARS = 30
+
+DEFAULTS = {
+    'years': 10,
+    'rentEscalation': 0.01,
+    'discountRate': 0.05,
+    'loanRatio': 0.0,
+    'interestRate': 0.015,
+    'loanYears': 30
+}
+
+
+def normalize_assumptions(data):
+    """予測条件を検証し、既定値で補完"""
+    assumptions = {}
+    try:
+        for key, default in DEFAULTS.items():
+            value = data.get(key, default) if data else default
+            assumptions[key] = int(value) if isinstance(default, int) else float(value)
+    except (TypeError, ValueError):
+        raise ScenarioError('Invalid projection assumptions')
+
+    if not MIN_YEARS <= assumptions['years'] <= MAX_YEARS:
+        raise ScenarioError(f'years must be between {MIN_YEARS} and {MAX_YEARS}')
+    if not 0 <= assumptions['loanRatio'] <= 1:
+        raise ScenarioError('loanRatio must be between 0 and 1')
+    if assumptions['loanYears'] < 1:
+        raise ScenarioError('loanYears must be positive')
+    if not assumptions['discountRate'] > -1:
+        raise ScenarioError('discountRate must be greater than -1')
+    if not assumptions['interestRate'] >= 0:
+        raise ScenarioError('interestRate must not be negative')
+    return assumptions
+
+
+# 各系列は入力が同じなら再計算しないようキャッシュし、
+# 条件を1つ変えたときは影響する系列だけを作り直す
+
+@lru_cache(maxsize=1024)
+def _operating_income_series(seasonality, annual_revenue, expenses_rate, months):
+    """季節変動込みの月次売上から変動経費を引いた系列"""
+    monthly = [annual_revenue / 12 * factor * (1 - expenses_rate) for factor in seasonality]
+    return tuple(monthly[m % 12] for m in range(months))
+
+
+@lru_cache(maxsize=1024)
+def _rent_series(monthly_rent, escalation, months):
+    """年次で家賃が上昇する月次家賃の系列"""
+    yearly = [monthly_rent * (1 + escalation) ** year for year in range(months // 12 + 1)]
+    return tuple(yearly[m // 12] for m in range(months))
+
+
+@lru_cache(maxsize=1024)
+def _loan_series(principal, interest_rate, loan_months, months):
+    """元利均等返済の月次返済額の系列"""
+    if principal <= 0:
+        return (0.0,) * months
+    rate = interest_rate / 12
+    if rate > 0:
+        payment = principal * rate / (1 - (1 + rate) ** -loan_months)
+    else:
+        payment = principal / loan_months
+    paid_months = min(loan_months, months)
+    return (payment,) * paid_months + (0.0,) * (months - paid_months)
+
+
+@lru_cache(maxsize=64)
+def _discount_factors(discount_rate, months):
+    monthly_rate = (1 + discount_rate) ** (1 / 12) - 1
+    return tuple((1 + monthly_rate) ** -(m + 1) for m in range(months))
+
+
+@lru_cache(maxsize=4096)
+def irr(flows):
+    """キャッシュフロー（期首の投資を含む）の内部収益率。解がなければNone"""
+    if not any(flow > 0 for flow in flows) or not any(flow < 0 for flow in flows):
+        return None
+
+    def npv(rate):
+        return sum(flow / (1 + rate) ** t for t, flow in enumerate(flows))
+
+    low, high = -0.99, 10.0
+    npv_low, npv_high = npv(low), npv(high)
+    if npv_low * npv_high > 0:
+        return None
+    for _ in range(100):
+        mid = (low + high) / 2
+        npv_mid = npv(mid)
+        if abs(npv_mid) < 1e-6 or high - low < 1e-9:
+            break
+        if npv_low * npv_mid < 0:
+            high = mid
+        else:
+            low, npv_low = mid, npv_mid
+    return mid
+
+
+def project_cash_flow(scenario, assumptions, include_monthly=True):
+    """月次キャッシュフローの長期予測とNPV・IRRを計算"""
+    months = assumptions['years'] * 12
+    columns = build_columns([scenario])
+    annual_revenue = calculate_columns(columns)['annualRevenue'][0]
+    expenses_rate = columns['expensesRate'][0]
+    seasonality = get_market_table().lookup(scenario['region'], scenario.get('ward')).seasonality
+
+    income = _operating_income_series(seasonality, annual_revenue, expenses_rate, months)
+
+    if scenario['operationType'] == SUBLEASE:
+        rent = _rent_series(scenario['monthlyRent'], assumptions['rentEscalation'], months)
+        loan = (0.0,) * months
+        principal = 0
+    else:
+        rent = (0.0,) * months
+        principal = scenario['purchasePrice'] * assumptions['loanRatio']
+        loan = _loan_series(principal, assumptions['interestRate'], assumptions['loanYears'] * 12, months)
+
+    initial_outlay = scenario['purchasePrice'] + scenario['renovationCost'] + scenario['initialCost'] - principal
+    cash_flow = [i - r - l for i, r, l in zip(income, rent, loan)]
+
+    discount = _discount_factors(assumptions['discountRate'], months)
+    npv = -initial_outlay + sum(flow * factor for flow, factor in zip(cash_flow, discount))
+
+    annual = [sum(cash_flow[start:start + 12]) for start in range(0, months, 12)]
+    cumulative = []
+    running = -initial_outlay
+    for flow in annual:
+        running += flow
+        cumulative.append(round(running))
+
+    payback_month = None
+    running = -initial_outlay
+    for month, flow in enumerate(cash_flow, 1):
+        running += flow
+        if running >= 0:
+            payback_month = month
+            break
+
+    annual_irr = irr(tuple([-initial_outlay] + [round(flow) for flow in annual]))
+
+    projection = {
+        'years': assumptions['years'],
+        'initialOutlay': round(initial_outlay),
+        'loanPrincipal': round(principal),
+        'annualCashFlow': [round(flow) for flow in annual],
+        'cumulativeCashFlow': cumulative,
+        'npv': round(npv),
+        'irr': round(annual_irr * 100, 2) if annual_irr is not None else None,
+        'paybackMonth': payback_month
+    }
+    if include_monthly:
+        projection['monthlyCashFlow'] = [round(flow) for flow in cash_flow]
+    return projection
+
+
+def project_portfolio(scenarios, assumptions, include_monthly=False):
+    """複数物件の予測と、合算したキャッシュフロー・NPV・IRR"""
+    projections = [project_cash_flow(s, assumptions, include_monthly) for s in scenarios]
+
+    total_outlay = sum(p['initialOutlay'] for p in projections)
+    total_annual = [sum(values) for values in zip(*(p['annualCashFlow'] for p in projections))]
+    portfolio_irr = irr(tuple([-total_outlay] + total_annual))
+
+    return {
+        'projections': projections,
+        'portfolio': {
+            'initialOutlay': total_outlay,
+            'annualCashFlow': total_annual,
+            'npv': sum(p['npv'] for p in projections),
+            'irr': round(portfolio_irr * 100, 2) if portfolio_irr is not None else None
+        }
+    }
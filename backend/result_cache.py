@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.environ.get('SIMULATION_CACHE_SIZE', '1024'))
+CACHE_TTL = float(os.environ.get('SIMULATION_CACHE_TTL', '300'))
+
+
+def canonical_key(normalized):
+    """正規化済み入力からキャッシュキー（ハッシュ）を作成"""
+    payload = json.dumps(normalized, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """件数上限とTTLを持つスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """キャッシュを参照（なければNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """キャッシュに登録し、上限を超えたら最も古いものから削除"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ヒット・ミス・削除の件数"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxSize': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
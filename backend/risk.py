@@ -0,0 +1,156 @@
+import multiprocessing
+import os
+import random
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from market_data import get_market_table
+from simulation import ScenarioError, build_columns, calculate_columns
+
+# サンプルは純Pythonで生成する（1コアあたり毎秒6万〜15万件程度）ので、既定値は時間内に終わる件数にする
+DEFAULT_SAMPLES = int(os.environ.get('RISK_DEFAULT_SAMPLES', '20000'))
+MAX_SAMPLES = int(os.environ.get('RISK_MAX_SAMPLES', '200000'))
+# 時間の上限（リクエストの timeBudgetMs はこれ以下に切り詰める）
+TIME_BUDGET_MS = int(os.environ.get('RISK_TIME_BUDGET_MS', '2000'))
+# 集計（ソート）にかかる時間の見積もり。この分を残してサンプル生成を打ち切る
+SUMMARY_SECONDS_PER_SAMPLE = 1e-6
+# 計算用プロセス数（既定はCPU数をgunicornのワーカー数で割った数。ホスト全体でCPU数程度に収める）
+RISK_WORKERS = int(os.environ.get(
+    'RISK_WORKERS', str(max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', '1'))))
+))
+
+# チャンクの大きさは固定し、並列でも直列でも同じシードなら同じ結果になるようにする
+CHUNK_SIZE = 25000
+# これ以下のサンプル数はプロセスプールを使わずに計算
+PARALLEL_THRESHOLD = 2 * CHUNK_SIZE
+
+PERCENTILES = {'p10': 0.10, 'p50': 0.50, 'p90': 0.90}
+
+_executor = None
+
+
+def _get_executor():
+    """プロセスプールを初回利用時に作成
+
+    ワーカーでは保存・送信のスレッドが動いているため、forkではなくforkserverで起動する
+    （fork時に他のスレッドが持っていたロックで子プロセスが止まるのを防ぐ）。
+    """
+    global _executor
+    if _executor is None:
+        context = multiprocessing.get_context('forkserver')
+        _executor = ProcessPoolExecutor(max_workers=RISK_WORKERS, mp_context=context)
+    return _executor
+
+
+def _simulate_chunk(base, volatility, seed, index, size):
+    """1チャンク分のサンプルを生成して計算"""
+    rng = random.Random(seed * 1000003 + index)
+    gauss = rng.gauss
+
+    occupancy = [min(max(gauss(base['occupancy'], volatility['occupancy_sd']), 0.0), 1.0) for _ in range(size)]
+    daily_rates = [base['baseDailyRate'] * max(gauss(1.0, volatility['rate_sd']), 0.0) for _ in range(size)]
+    expenses_rates = [min(max(gauss(base['expensesRate'], volatility['expenses_sd']), 0.0), 1.0) for _ in range(size)]
+
+    columns = {key: [value] * size for key, value in base.items()}
+    columns['occupancy'] = occupancy
+    columns['baseDailyRate'] = daily_rates
+    columns['expensesRate'] = expenses_rates
+    computed = calculate_columns(columns)
+
+    # チャンクごとにソートしておくと、全体のソートは整列済みの列の併合で済む
+    return (
+        array('d', sorted(computed['annualProfit'])),
+        array('d', sorted(computed['roi'])),
+        array('d', sorted(computed['recoveryPeriod']))
+    )
+
+
+def _summarize(values):
+    """ソート済みの値のパーセンタイルと平均"""
+    last = len(values) - 1
+    summary = {name: values[round(q * last)] for name, q in PERCENTILES.items()}
+    summary['mean'] = sum(values) / len(values)
+    return summary
+
+
+def run_monte_carlo(scenario, samples=None, seed=None, time_budget_ms=None):
+    """稼働率・単価・経費率をばらつかせた確率的シミュレーション"""
+    try:
+        samples = int(samples or DEFAULT_SAMPLES)
+        seed = int(seed) if seed is not None else random.SystemRandom().randrange(2 ** 32)
+    except (TypeError, ValueError):
+        raise ScenarioError('samples and seed must be integers')
+    if samples < 1 or samples > MAX_SAMPLES:
+        raise ScenarioError(f'samples must be between 1 and {MAX_SAMPLES}')
+    try:
+        budget_ms = float(time_budget_ms) if time_budget_ms is not None else TIME_BUDGET_MS
+    except (TypeError, ValueError):
+        raise ScenarioError('timeBudgetMs must be a number')
+    if not budget_ms > 0:
+        raise ScenarioError('timeBudgetMs must be positive')
+    budget = min(budget_ms, TIME_BUDGET_MS) / 1000
+
+    base = {key: values[0] for key, values in build_columns([scenario]).items()}
+    rates = get_market_table().lookup(scenario['region'], scenario.get('ward'))
+    volatility = {
+        'occupancy_sd': rates.occupancy_sd,
+        'rate_sd': rates.rate_sd,
+        'expenses_sd': rates.expenses_sd
+    }
+    sizes = [min(CHUNK_SIZE, samples - start) for start in range(0, samples, CHUNK_SIZE)]
+
+    started = time.monotonic()
+    deadline = started + budget
+    chunks = []
+    if samples <= PARALLEL_THRESHOLD or RISK_WORKERS <= 1:
+        collected = 0
+        for index, size in enumerate(sizes):
+            if chunks:
+                # 次のチャンクと、それを含めた集計が期限内に終わらなければ打ち切る
+                now = time.monotonic()
+                chunk_seconds = (now - started) / len(chunks)
+                if now + chunk_seconds + (collected + size) * SUMMARY_SECONDS_PER_SAMPLE > deadline:
+                    break
+            chunks.append(_simulate_chunk(base, volatility, seed, index, size))
+            collected += size
+    else:
+        executor = _get_executor()
+        futures = [
+            executor.submit(_simulate_chunk, base, volatility, seed, index, size)
+            for index, size in enumerate(sizes)
+        ]
+        # 全サンプルの集計にかかる時間を残して待つ（予算の半分まで）
+        reserve = min(samples * SUMMARY_SECONDS_PER_SAMPLE, budget / 2)
+        done, pending = wait(futures, timeout=budget - reserve)
+        if not done:
+            # 最低1チャンクは待ってから返す
+            futures[0].result()
+            done.add(futures[0])
+            pending.discard(futures[0])
+        for future in pending:
+            future.cancel()
+        # 期限切れでも結果を返せるよう、完了済みのチャンクだけを集計
+        chunks = [future.result() for future in futures if future in done]
+
+    profits = array('d')
+    rois = array('d')
+    recovery_periods = array('d')
+    for profit, roi, recovery in chunks:
+        profits.extend(profit)
+        rois.extend(roi)
+        recovery_periods.extend(recovery)
+
+    completed = len(profits)
+    profits = sorted(profits)
+    return {
+        'samples': completed,
+        'requestedSamples': samples,
+        'seed': seed,
+        'truncated': completed < samples,
+        'lossProbability': bisect_left(profits, 0) / completed,
+        'annualProfit': _summarize(profits),
+        'roi': _summarize(sorted(rois)),
+        'recoveryPeriod': _summarize(sorted(recovery_periods))
+    }
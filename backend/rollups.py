@@ -0,0 +1,182 @@
+import json
+import math
+from datetime import datetime, timezone
+
+# 相対誤差1%の対数バケットによる近似分位点スケッチ（加算でマージ可能）
+SKETCH_ACCURACY = 0.01
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+# これ以下の値は0のバケットに入れる
+_MIN_VALUE = 1e-6
+
+ROLLUP_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS simulation_rollups (
+        day TEXT NOT NULL,
+        region TEXT NOT NULL,
+        minpaku_law TEXT NOT NULL,
+        operation_type TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        roi_sum REAL NOT NULL,
+        recovery_sketch TEXT NOT NULL,
+        PRIMARY KEY (day, region, minpaku_law, operation_type)
+    )
+'''
+
+GROUP_KEYS = ['region', 'minpaku_law', 'operation_type']
+
+
+class QuantileSketch:
+    """マージ可能な近似分位点スケッチ"""
+
+    def __init__(self, buckets=None, zero=0):
+        self.buckets = buckets or {}
+        self.zero = zero
+
+    @property
+    def count(self):
+        return self.zero + sum(self.buckets.values())
+
+    def add(self, value, count=1):
+        if value is None or value <= _MIN_VALUE:
+            self.zero += count
+            return
+        index = math.ceil(math.log(value) / _LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        self.zero += other.zero
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def quantile(self, q):
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * _GAMMA ** index / (_GAMMA + 1)
+        return 2 * _GAMMA ** max(self.buckets) / (_GAMMA + 1)
+
+    def to_json(self):
+        return json.dumps({'z': self.zero, 'b': self.buckets}, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        return cls({int(index): count for index, count in data['b'].items()}, data['z'])
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_rollups(conn, rows, day=None):
+    """保存時に該当グループの集計を更新（保存と同じトランザクション内で呼ぶ）
+
+    rows は (region, minpaku_law, operation_type, roi, recovery_period) の並び。
+    バッチ内で同じグループの行を先に合算し、グループごとに1回だけ読み書きする。
+    """
+    day = day or datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    groups = {}
+    for region, minpaku_law, operation_type, roi, recovery_period in rows:
+        key = (day, str(region), str(minpaku_law), str(operation_type))
+        group = groups.setdefault(key, [0, 0.0, QuantileSketch()])
+        group[0] += 1
+        group[1] += _float(roi) or 0.0
+        group[2].add(_float(recovery_period))
+
+    for key, (count, roi_sum, sketch) in groups.items():
+        row = conn.execute('''
+            SELECT count, roi_sum, recovery_sketch FROM simulation_rollups
+            WHERE day = ? AND region = ? AND minpaku_law = ? AND operation_type = ?
+        ''', key).fetchone()
+        if row:
+            count += row[0]
+            roi_sum += row[1]
+            sketch.merge(QuantileSketch.from_json(row[2]))
+
+        conn.execute('''
+            INSERT OR REPLACE INTO simulation_rollups (
+                day, region, minpaku_law, operation_type, count, roi_sum, recovery_sketch
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', key + (count, roi_sum, sketch.to_json()))
+
+
+def rebuild_rollups(conn):
+    """simulationsテーブル全体から集計を作り直す（初回移行・定期的な整合用）"""
+    groups = {}
+    cursor = conn.execute('''
+        SELECT date(created_at), region, minpaku_law, operation_type, roi, recovery_period
+        FROM simulations
+    ''')
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows:
+            break
+        for day, region, minpaku_law, operation_type, roi, recovery_period in rows:
+            key = (day or '', str(region), str(minpaku_law), str(operation_type))
+            group = groups.setdefault(key, [0, 0.0, QuantileSketch()])
+            group[0] += 1
+            group[1] += _float(roi) or 0.0
+            group[2].add(_float(recovery_period))
+
+    conn.execute('DELETE FROM simulation_rollups')
+    conn.executemany('''
+        INSERT INTO simulation_rollups (
+            day, region, minpaku_law, operation_type, count, roi_sum, recovery_sketch
+        ) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [key + (count, roi_sum, sketch.to_json()) for key, (count, roi_sum, sketch) in groups.items()])
+
+
+def query_rollups(conn, date_from=None, date_to=None, filters=None, by_day=True):
+    """集計テーブルからグループ別の件数・平均ROI・回収期間の中央値を取得"""
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append('day >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('day < ?')
+        params.append(date_to)
+    for column, value in (filters or {}).items():
+        if column in GROUP_KEYS and value:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    merged = {}
+    for day, region, minpaku_law, operation_type, count, roi_sum, sketch in conn.execute(f'''
+        SELECT day, region, minpaku_law, operation_type, count, roi_sum, recovery_sketch
+        FROM simulation_rollups {where}
+        ORDER BY day, region, minpaku_law, operation_type
+    ''', params):
+        key = (day if by_day else None, region, minpaku_law, operation_type)
+        group = merged.setdefault(key, [0, 0.0, QuantileSketch()])
+        group[0] += count
+        group[1] += roi_sum
+        group[2].merge(QuantileSketch.from_json(sketch))
+
+    results = []
+    for (day, region, minpaku_law, operation_type), (count, roi_sum, sketch) in merged.items():
+        median = sketch.quantile(0.5)
+        result = {
+            'region': region,
+            'minpakuLaw': minpaku_law,
+            'operationType': operation_type,
+            'count': count,
+            'averageRoi': round(roi_sum / count, 2) if count else None,
+            'medianRecoveryPeriod': round(median, 1) if median is not None else None
+        }
+        if by_day:
+            result['day'] = day
+        results.append(result)
+    return results
@@ -0,0 +1,380 @@
+import hashlib
+import json
+import os
+from itertools import product
+
+from market_data import get_market_table
+
+# 民泊新法（180日制限）の選択肢
+SHINPO_LAW = '民泊新法対応（180日制限あり）'
+SUBLEASE = '転貸'
+
+# 収容人数1名あたりの単価調整率（2名基準）
+CAPACITY_STEP = 0.15
+
+REQUIRED_FIELDS = ['region', 'operationType', 'propertyType', 'area', 'capacity', 'minpakuLaw']
+AMOUNT_FIELDS = ['monthlyRent', 'purchasePrice', 'renovationCost', 'initialCost']
+
+# 感度分析で変化させられる軸
+SWEEP_AXES = ['occupancy', 'capacity', 'monthlyRent', 'renovationCost', 'minpakuLaw']
+SWEEP_METRICS = ['roi', 'recoveryPeriod']
+MAX_SWEEP_POINTS = int(os.environ.get('MAX_SWEEP_POINTS', '250000'))
+
+# 係数表を事前計算する選択肢（画面の収容人数は1〜8名、営業日数の上限は民泊新法かそれ以外）
+PRESET_CAPACITIES = tuple(range(1, 9))
+PRESET_MAX_DAYS = (180, 365)
+
+
+class ScenarioError(ValueError):
+    """シナリオ入力の検証エラー"""
+
+
+def normalize_scenario(data):
+    """入力データを検証し、数値項目をintに揃える"""
+    if not isinstance(data, dict):
+        raise ScenarioError('Scenario must be a JSON object')
+
+    for field in REQUIRED_FIELDS:
+        if field not in data:
+            raise ScenarioError(f'Missing required field: {field}')
+
+    scenario = {
+        'region': data['region'],
+        'operationType': data['operationType'],
+        'propertyType': data['propertyType'],
+        'area': _to_int(data['area'], 'area'),
+        'capacity': _to_int(data['capacity'], 'capacity'),
+        'minpakuLaw': data['minpakuLaw']
+    }
+    for field in AMOUNT_FIELDS:
+        scenario[field] = _to_int(data.get(field, 0), field)
+    # 区・市単位の市場データを使う場合のみ指定
+    if data.get('ward'):
+        scenario['ward'] = str(data['ward'])
+
+    return scenario
+
+
+def _to_int(value, field):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ScenarioError(f'Invalid integer for field: {field}')
+
+
+def load_ndjson(lines):
+    """NDJSONの各行をシナリオに変換（壊れた行はScenarioErrorとして残す）"""
+    scenarios = []
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            scenarios.append(json.loads(line))
+        except ValueError:
+            scenarios.append(ScenarioError(f'Invalid JSON on line {number}'))
+    return scenarios
+
+
+def build_columns(scenarios):
+    """正規化済みシナリオを列指向の計算入力に展開"""
+    columns = {
+        'baseDailyRate': [],
+        'occupancy': [],
+        'expensesRate': [],
+        'capacity': [],
+        'maxDays': [],
+        'annualRent': [],
+        'totalInvestment': []
+    }
+    market = get_market_table()
+    for s in scenarios:
+        rates = market.lookup(s['region'], s.get('ward'))
+        columns['baseDailyRate'].append(rates.daily_rate)
+        columns['occupancy'].append(rates.occupancy)
+        columns['expensesRate'].append(rates.expenses_rate)
+        columns['capacity'].append(s['capacity'])
+        columns['maxDays'].append(180 if s['minpakuLaw'] == SHINPO_LAW else 365)
+        columns['annualRent'].append(s['monthlyRent'] * 12 if s['operationType'] == SUBLEASE else 0)
+        columns['totalInvestment'].append(s['purchasePrice'] + s['renovationCost'] + s['initialCost'])
+    return columns
+
+
+def calculate_columns(columns):
+    """列ごとに全シナリオの収益指標をまとめて計算"""
+    daily_rates = [
+        int(rate * (1 + (capacity - 2) * CAPACITY_STEP))
+        for rate, capacity in zip(columns['baseDailyRate'], columns['capacity'])
+    ]
+    operating_days = [int(days * occ) for days, occ in zip(columns['maxDays'], columns['occupancy'])]
+    revenues = [rate * days for rate, days in zip(daily_rates, operating_days)]
+    expenses = [
+        int(revenue * rate) + rent
+        for revenue, rate, rent in zip(revenues, columns['expensesRate'], columns['annualRent'])
+    ]
+    profits = [revenue - expense for revenue, expense in zip(revenues, expenses)]
+    investments = columns['totalInvestment']
+    rois = [
+        round(profit / investment * 100, 2) if investment > 0 else 0
+        for profit, investment in zip(profits, investments)
+    ]
+    recovery_periods = [
+        round(investment / profit, 1) if profit > 0 else 999
+        for profit, investment in zip(profits, investments)
+    ]
+
+    return {
+        'dailyRate': daily_rates,
+        'operatingDays': operating_days,
+        'annualRevenue': revenues,
+        'annualExpenses': expenses,
+        'annualProfit': profits,
+        'totalInvestment': investments,
+        'roi': rois,
+        'recoveryPeriod': recovery_periods
+    }
+
+
+def calculate_batch(items):
+    """複数シナリオを一括計算し、行ごとの結果とエラーを返す"""
+    scenarios = []
+    positions = []
+    errors = []
+    for index, data in enumerate(items):
+        try:
+            if isinstance(data, ScenarioError):
+                raise data
+            scenarios.append(normalize_scenario(data))
+            positions.append(index)
+        except ScenarioError as e:
+            errors.append({'index': index, 'error': str(e)})
+
+    computed = calculate_columns(build_columns(scenarios))
+
+    results = [None] * len(items)
+    for row, (index, scenario) in enumerate(zip(positions, scenarios)):
+        result = dict(scenario)
+        for key, values in computed.items():
+            result[key] = values[row]
+        results[index] = result
+
+    return results, errors
+
+
+class ScenarioTable:
+    """地域×収容人数×営業日数上限ごとの係数（1泊単価・稼働日数・売上・変動経費）の表
+
+    金額（家賃・購入価格・費用）は計算式に線形に入るだけなので、係数を引けば
+    残りは数回の加算・乗算で済む。係数は calculate_columns で一括計算して作る。
+    """
+
+    def __init__(self, market, capacities=PRESET_CAPACITIES, max_days=PRESET_MAX_DAYS):
+        self.market = market
+        self.capacities = tuple(capacities)
+        self.max_days = tuple(max_days)
+        self._document = None
+
+        combos = list(product(market.areas, self.capacities, self.max_days))
+        computed = calculate_columns({
+            'baseDailyRate': [rates.daily_rate for rates, _, _ in combos],
+            'occupancy': [rates.occupancy for rates, _, _ in combos],
+            'expensesRate': [rates.expenses_rate for rates, _, _ in combos],
+            'capacity': [capacity for _, capacity, _ in combos],
+            'maxDays': [days for _, _, days in combos],
+            'annualRent': [0] * len(combos),
+            'totalInvestment': [0] * len(combos)
+        })
+        # 家賃0で計算した経費が変動経費（売上×経費率）
+        self._coefficients = {
+            (rates.region, rates.ward, capacity, days): row
+            for (rates, capacity, days), row in zip(combos, zip(
+                computed['dailyRate'], computed['operatingDays'],
+                computed['annualRevenue'], computed['annualExpenses']
+            ))
+        }
+
+    def coefficients(self, scenario):
+        """正規化済みシナリオの係数（表にない組み合わせはNone）"""
+        rates = self.market.lookup(scenario['region'], scenario.get('ward'))
+        days = 180 if scenario['minpakuLaw'] == SHINPO_LAW else 365
+        return self._coefficients.get((rates.region, rates.ward, scenario['capacity'], days))
+
+    def document(self):
+        """フロントエンドの試算用のJSON（版, バイト列）
+
+        配列は [地域][収容人数][営業日数上限] の順。
+        年間経費 = variableExpenses + 月額家賃×12（転貸のみ）、総投資額 = 購入価格 + リノベーション費用 + 初期費用
+        """
+        if self._document is None:
+            areas = self.market.areas
+            rows = [
+                [[self._coefficients[(rates.region, rates.ward, capacity, days)] for days in self.max_days]
+                 for capacity in self.capacities]
+                for rates in areas
+            ]
+
+            def grid(position):
+                return [[[row[position] for row in by_days] for by_days in by_area] for by_area in rows]
+
+            body = {
+                'marketDataVersion': self.market.version,
+                'regions': [{'region': rates.region, 'ward': rates.ward} for rates in areas],
+                'aliases': dict(self.market.aliases),
+                'defaultRegion': self.market.default_region,
+                'capacities': list(self.capacities),
+                'maxDays': list(self.max_days),
+                'shinpoLaw': SHINPO_LAW,
+                'subleaseOperationType': SUBLEASE,
+                'dailyRate': grid(0),
+                'operatingDays': grid(1),
+                'annualRevenue': grid(2),
+                'variableExpenses': grid(3)
+            }
+            payload = json.dumps(body, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+            version = hashlib.blake2b(payload.encode('utf-8'), digest_size=8).hexdigest()
+            body['version'] = version
+            self._document = (version, json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        return self._document
+
+
+_scenario_table = None
+
+
+def get_scenario_table():
+    """現在の市場データの係数表（市場データが差し替わったら作り直す）"""
+    global _scenario_table
+    market = get_market_table()
+    table = _scenario_table
+    if table is None or table.market is not market:
+        table = _scenario_table = ScenarioTable(market)
+    return table
+
+
+def calculate_scenario(data):
+    """単一シナリオを計算（検証エラー時はScenarioError）
+
+    係数表にある組み合わせは表を引いて計算し、それ以外は一括計算と同じ経路で計算する。
+    """
+    scenario = normalize_scenario(data)
+    coefficients = get_scenario_table().coefficients(scenario)
+    if coefficients is None:
+        results, errors = calculate_batch([scenario])
+        return results[0]
+
+    daily_rate, operating_days, revenue, variable_expenses = coefficients
+    expenses = variable_expenses + (scenario['monthlyRent'] * 12 if scenario['operationType'] == SUBLEASE else 0)
+    profit = revenue - expenses
+    investment = scenario['purchasePrice'] + scenario['renovationCost'] + scenario['initialCost']
+
+    result = dict(scenario)
+    result['dailyRate'] = daily_rate
+    result['operatingDays'] = operating_days
+    result['annualRevenue'] = revenue
+    result['annualExpenses'] = expenses
+    result['annualProfit'] = profit
+    result['totalInvestment'] = investment
+    result['roi'] = round(profit / investment * 100, 2) if investment > 0 else 0
+    result['recoveryPeriod'] = round(investment / profit, 1) if profit > 0 else 999
+    return result
+
+
+def expand_axis(name, spec, max_points=None):
+    """軸の指定（値の配列または start/stop/steps）を値の配列に展開（max_points個まで等間隔に間引く）"""
+    if name not in SWEEP_AXES:
+        raise ScenarioError(f'Unsupported sweep axis: {name}')
+
+    if isinstance(spec, dict):
+        try:
+            start = float(spec['start'])
+            stop = float(spec['stop'])
+            steps = int(spec.get('steps', 2))
+        except (KeyError, TypeError, ValueError):
+            raise ScenarioError(f'Invalid range for axis: {name}')
+        if steps < 1:
+            raise ScenarioError(f'Invalid range for axis: {name}')
+        # 全点の配列は作らず、間引いた後の点だけを計算する
+        count = min(steps, max_points) if max_points else steps
+        if count > MAX_SWEEP_POINTS:
+            raise ScenarioError(f'Too many grid points (max {MAX_SWEEP_POINTS})')
+        if steps == 1:
+            values = [start]
+        else:
+            indices = downsample(range(steps), count)
+            values = [start + (stop - start) * i / (steps - 1) for i in indices]
+    elif isinstance(spec, list) and spec:
+        values = downsample(spec, max_points)
+    else:
+        raise ScenarioError(f'Invalid values for axis: {name}')
+
+    if name == 'minpakuLaw':
+        return [str(value) for value in values]
+    if name == 'occupancy':
+        try:
+            values = [float(value) for value in values]
+        except (TypeError, ValueError):
+            raise ScenarioError(f'Invalid values for axis: {name}')
+        if any(value < 0 or value > 1 for value in values):
+            raise ScenarioError('Occupancy must be between 0 and 1')
+        return values
+    return [_to_int(round(value) if isinstance(value, float) else value, name) for value in values]
+
+
+def downsample(values, max_points):
+    """等間隔に間引いて最大max_points個にする（両端は残す）"""
+    if not max_points or len(values) <= max_points:
+        return values
+    if max_points == 1:
+        return values[:1]
+    last = len(values) - 1
+    return [values[round(i * last / (max_points - 1))] for i in range(max_points)]
+
+
+def sweep_grid(base, axes, metrics=None, max_points_per_axis=None):
+    """基準シナリオの各軸を変化させたグリッドを一括計算"""
+    scenario = normalize_scenario(base)
+    if not isinstance(axes, dict) or not axes:
+        raise ScenarioError('At least one sweep axis is required')
+
+    if max_points_per_axis:
+        max_points_per_axis = _to_int(max_points_per_axis, 'maxPointsPerAxis')
+        if max_points_per_axis < 1:
+            raise ScenarioError('maxPointsPerAxis must be at least 1')
+
+    metrics = metrics or SWEEP_METRICS
+    names = list(axes)
+    axis_values = [expand_axis(name, axes[name], max_points_per_axis) for name in names]
+
+    total = 1
+    for values in axis_values:
+        total *= len(values)
+    if total > MAX_SWEEP_POINTS:
+        raise ScenarioError(f'Too many grid points (max {MAX_SWEEP_POINTS})')
+
+    # 基準シナリオの列を全点に展開し、変化させる軸の列だけ差し替える
+    columns = {key: values * total for key, values in build_columns([scenario]).items()}
+    combos = list(product(*axis_values))
+    sublease = scenario['operationType'] == SUBLEASE
+    fixed_investment = scenario['purchasePrice'] + scenario['initialCost']
+    for position, name in enumerate(names):
+        values = [combo[position] for combo in combos]
+        if name in ('occupancy', 'capacity'):
+            columns[name] = values
+        elif name == 'minpakuLaw':
+            columns['maxDays'] = [180 if value == SHINPO_LAW else 365 for value in values]
+        elif name == 'monthlyRent':
+            columns['annualRent'] = [value * 12 if sublease else 0 for value in values]
+        elif name == 'renovationCost':
+            columns['totalInvestment'] = [fixed_investment + value for value in values]
+
+    computed = calculate_columns(columns)
+    unknown = [metric for metric in metrics if metric not in computed]
+    if unknown:
+        raise ScenarioError(f'Unsupported metric: {unknown[0]}')
+
+    return {
+        'axes': [{'name': name, 'values': values} for name, values in zip(names, axis_values)],
+        'shape': [len(values) for values in axis_values],
+        'metrics': {metric: computed[metric] for metric in metrics}
+    }
@@ -0,0 +1,167 @@
+"""静的ファイルの配信（ETag・圧縮済みデータ・キャッシュヘッダー）
+
+ファイルごとに強いETagとgzip（brotliモジュールがあればbrotliも）の圧縮データを一度だけ作り、
+更新時刻が変わったときに作り直す。
+If-None-Match が一致すれば304、Accept-Encoding に応じて圧縮済みデータを返す。
+無圧縮の場合はファイルをそのまま渡す（gunicornなどでは sendfile で送られる）。
+add() で登録したメモリ上のデータ（起動時に生成するJSONなど）も同じ方法で配信する。
+
+キャッシュヘッダー:
+    バージョン付き（?v=... またはファイル名にハッシュ: app.3f2a9c1d.js） 1年・immutable
+    HTML                                                               毎回ETagで再検証
+    その他                                                             STATIC_MAX_AGE 秒
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import Response, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '3600'))
+# これより小さい・大きいファイルは圧縮しない
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_MAX_BYTES = int(os.environ.get('STATIC_COMPRESS_MAX_BYTES', str(8 * 1024 * 1024)))
+# 圧縮する形式
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+VERSIONED_NAME = re.compile(r'\.[0-9a-f]{8,}\.[A-Za-z0-9]+$')
+
+
+class _Asset:
+    __slots__ = ('path', 'mtime', 'size', 'mimetype', 'etag', 'variants', 'data')
+
+    def __init__(self, path, mtime, size, mimetype, etag, variants, data=None):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.mimetype = mimetype
+        self.etag = etag
+        # {'br': bytes, 'gzip': bytes}
+        self.variants = variants
+        # メモリ上のデータ（ファイルの場合はNone）
+        self.data = data
+
+
+def _load(path, stat):
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    with open(path, 'rb') as f:
+        data = f.read()
+    return _build(data, mimetype, path, stat.st_mtime_ns, stat.st_size)
+
+
+def _build(data, mimetype, path=None, mtime=None, size=None):
+    etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    variants = {}
+    if COMPRESS_MIN_BYTES <= len(data) <= COMPRESS_MAX_BYTES and mimetype.startswith(COMPRESSIBLE_TYPES):
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data):
+            variants['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(data, mode=brotli.MODE_TEXT)
+            if len(compressed) < len(data):
+                variants['br'] = compressed
+    return _Asset(path, mtime, size, mimetype, etag, variants, None if path else data)
+
+
+class StaticAssets:
+    """ディレクトリ内の静的ファイルの索引"""
+
+    def __init__(self, root):
+        self.root = root
+        self._assets = {}
+        self._generated = {}
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """起動時にすべてのファイルのETag・圧縮データを作成"""
+        if not os.path.isdir(self.root):
+            return 0
+        count = 0
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if self.get(os.path.relpath(os.path.join(directory, filename), self.root)) is not None:
+                    count += 1
+        return count
+
+    def add(self, filename, data, mimetype):
+        """メモリ上のデータを filename として配信（同名のファイルより優先）"""
+        asset = _build(data, mimetype)
+        with self._lock:
+            self._generated[filename] = asset
+        return asset
+
+    def discard(self, filename):
+        with self._lock:
+            self._generated.pop(filename, None)
+
+    def get(self, filename):
+        """ファイルの情報（存在しなければNone）。更新されていれば作り直す"""
+        asset = self._generated.get(filename)
+        if asset is not None:
+            return asset
+        path = safe_join(self.root, filename)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        asset = self._assets.get(path)
+        if asset is not None and asset.mtime == stat.st_mtime_ns and asset.size == stat.st_size:
+            return asset
+        with self._lock:
+            asset = self._assets.get(path)
+            if asset is None or asset.mtime != stat.st_mtime_ns or asset.size != stat.st_size:
+                asset = self._assets[path] = _load(path, stat)
+        return asset
+
+    def response(self, filename):
+        """リクエストに応じたレスポンス（なければ404）"""
+        asset = self.get(filename)
+        if asset is None:
+            return Response('Not Found', status=404, mimetype='text/plain')
+
+        encoding = next(
+            (name for name in ('br', 'gzip') if name in asset.variants and request.accept_encodings[name] > 0),
+            None
+        )
+        # 強いETagは表現（圧縮方式）ごとに変える
+        etag = f'{asset.etag}-{encoding}' if encoding else asset.etag
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        elif encoding:
+            response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+            response.headers['Content-Encoding'] = encoding
+        elif asset.data is not None:
+            response = Response(asset.data, mimetype=asset.mimetype)
+        else:
+            response = send_file(asset.path, mimetype=asset.mimetype, conditional=False, etag=False, max_age=None)
+
+        response.set_etag(etag)
+        if asset.variants:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = self.cache_control(filename, asset.mimetype)
+        return response
+
+    @staticmethod
+    def cache_control(filename, mimetype):
+        if request.args.get('v') or VERSIONED_NAME.search(filename):
+            return IMMUTABLE_CACHE_CONTROL
+        if mimetype == 'text/html':
+            return 'no-cache'
+        return f'public, max-age={STATIC_MAX_AGE}'
@@ -0,0 +1,341 @@
+import json
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+# Result store configuration
+RESULT_STORE = os.environ.get('RESULT_STORE', 'memory')
+RESULT_STORE_PATH = os.environ.get('RESULT_STORE_PATH', 'database/results.db')
+RESULT_STORE_SIZE = int(os.environ.get('RESULT_STORE_SIZE', '10000'))
+RESULT_STORE_TTL = float(os.environ.get('RESULT_STORE_TTL', '86400'))
+
+
+# Custom epoch for simulation IDs (2025-01-01T00:00:00Z, in milliseconds)
+ID_EPOCH_MS = 1735689600000
+ID_ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+ID_LENGTH = 16
+# 80-bit ID: 42 bits of milliseconds, 22 bits of process ID, 16-bit sequence
+_PID_BITS = 22
+_SEQUENCE_BITS = 16
+
+
+class SimulationIdGenerator:
+    """Time-ordered, monotonic IDs that are unique across the worker processes on a host"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def new_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # Same millisecond or the clock went back: keep counting from the last ID
+                self._sequence += 1
+                if self._sequence >> _SEQUENCE_BITS:
+                    self._last_ms += 1
+                    self._sequence = 0
+            value = (
+                (self._last_ms << (_PID_BITS + _SEQUENCE_BITS))
+                | ((os.getpid() & ((1 << _PID_BITS) - 1)) << _SEQUENCE_BITS)
+                | self._sequence
+            )
+
+        chars = []
+        for _ in range(ID_LENGTH):
+            chars.append(ID_ALPHABET[value & 31])
+            value >>= 5
+        return ''.join(reversed(chars))
+
+
+new_simulation_id = SimulationIdGenerator().new_id
+
+
+class LabelCodes:
+    """Small integer codes for labels repeated in every result; other values are kept as they are"""
+
+    def __init__(self, labels):
+        self.labels = tuple(labels)
+        self._codes = {label: code for code, label in enumerate(self.labels)}
+
+    def encode(self, label):
+        """Code for a known string label, or None (non-strings never get a code)"""
+        return self._codes.get(label) if isinstance(label, str) else None
+
+    def decode(self, value):
+        return self.labels[value] if isinstance(value, int) else value
+
+
+# Codes are stored in the shared SQLite store, so only ever append to these lists
+REGION_CODES = LabelCodes(['東京都', '大阪府', '京都府', '神奈川県', '愛知県', '福岡県', ''])
+OPERATION_TYPE_CODES = LabelCodes(['転貸', '購入', ''])
+MINPAKU_LAW_CODES = LabelCodes(['民泊新法対応', '旅館業法', '特区民泊', ''])
+PROPERTY_TYPE_CODES = LabelCodes(['1R', '1K', '1DK', '1LDK', '2K', '2DK', '2LDK', '3LDK', ''])
+
+
+# Fixed-size part of a record: label codes followed by the numeric results
+_CODE_FIELDS = ('region', 'operationType', 'propertyType', 'minpakuLaw')
+_CODE_TABLES = (REGION_CODES, OPERATION_TYPE_CODES, PROPERTY_TYPE_CODES, MINPAKU_LAW_CODES)
+_NUMERIC_FIELDS = (
+    ('area', 'q'), ('capacity', 'q'), ('dailyPrice', 'q'), ('occupancyRate', 'd'),
+    ('actualOperatingDays', 'q'), ('annualRevenue', 'q'), ('annualProfit', 'q'),
+    ('totalInvestment', 'q'), ('roi', 'd'), ('paybackPeriod', 'd'), ('renovationCost', 'q'),
+    ('monthlyRent', 'q'), ('purchasePrice', 'q')
+)
+_PACKED = struct.Struct('<4B' + ''.join(code for _, code in _NUMERIC_FIELDS) + 'd')
+# Code meaning "the label is stored in the extra part"
+_OTHER = 255
+
+
+class SimulationRecord:
+    """Compact stored form of a simulation result, expanded to the API shape on read
+
+    packed holds the label codes, the numbers and the creation time; extra is None or a
+    small JSON blob with the initial costs and any label value that has no code.
+    """
+
+    __slots__ = ('packed', 'extra')
+
+    def __init__(self, packed, extra=None):
+        self.packed = packed
+        self.extra = extra
+
+    @classmethod
+    def from_results(cls, results):
+        extra = {}
+        codes = []
+        for field, table in zip(_CODE_FIELDS, _CODE_TABLES):
+            code = table.encode(results[field])
+            if code is None or code >= _OTHER:
+                extra[field] = results[field]
+                code = _OTHER
+            codes.append(code)
+        if results['initialCosts']:
+            extra['initialCosts'] = results['initialCosts']
+
+        timestamp = results.get('timestamp')
+        created_at = datetime.fromisoformat(timestamp).timestamp() if timestamp else time.time()
+        try:
+            packed = _PACKED.pack(*codes, *(results[field] for field, _ in _NUMERIC_FIELDS), created_at)
+        except struct.error:
+            # Values outside the packed ranges are kept as they are
+            return cls(None, encode_results(results))
+        return cls(packed, encode_results(extra) if extra else None)
+
+    def to_results(self):
+        """The result dict returned by the API and used for LINE messages"""
+        if self.packed is None:
+            return json.loads(self.extra)
+        extra = json.loads(self.extra) if self.extra else {}
+        values = _PACKED.unpack(self.packed)
+
+        results = {}
+        for field, table, code in zip(_CODE_FIELDS, _CODE_TABLES, values):
+            results[field] = extra[field] if code == _OTHER else table.decode(code)
+        for (field, _), value in zip(_NUMERIC_FIELDS, values[len(_CODE_FIELDS):]):
+            results[field] = value
+        results['monthlyRevenue'] = results['annualRevenue'] / 12
+        results['monthlyProfit'] = results['annualProfit'] / 12
+        results['initialCosts'] = extra.get('initialCosts', {})
+        results['timestamp'] = datetime.fromtimestamp(values[-1]).isoformat()
+        return results
+
+    def nbytes(self):
+        """Approximate memory held by this record"""
+        return sys.getsizeof(self) + sys.getsizeof(self.packed) + (sys.getsizeof(self.extra) if self.extra else 0)
+
+
+def encode_results(results):
+    return json.dumps(results, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def encode_record(record):
+    """Row for the SQLite store: 1 byte for the packed length, the packed part, then the extra part"""
+    packed = record.packed or b''
+    return bytes([len(packed)]) + packed + (record.extra or b'')
+
+
+def decode_record(payload):
+    if payload[:1] == b'{':
+        # Written as a JSON dict before records were stored compactly
+        return SimulationRecord(None, bytes(payload))
+    length = payload[0]
+    return SimulationRecord(bytes(payload[1:1 + length]) or None, bytes(payload[1 + length:]) or None)
+
+
+class MemoryResultStore:
+    """Per-process LRU store of SimulationRecord objects with size and TTL limits"""
+
+    backend = 'memory'
+
+    def __init__(self, max_entries=RESULT_STORE_SIZE, ttl=RESULT_STORE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, key, record):
+        size = record.nbytes()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (time.time() + self.ttl, record, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, record, size = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+        return record
+
+    def purge_expired(self):
+        """Drop entries whose TTL has passed (get() only drops the entry it reads)"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (expires_at, _, _) in self._entries.items() if expires_at < now]
+            for key in expired:
+                self._bytes -= self._entries.pop(key)[2]
+        return len(expired)
+
+    def count(self):
+        """Number of live entries, matching what get() returns"""
+        self.purge_expired()
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'maxEntries': self.max_entries,
+                'ttl': self.ttl,
+                'evictions': self.evictions
+            }
+
+
+class SQLiteResultStore:
+    """Store shared by all workers on the host, backed by a SQLite file"""
+
+    backend = 'sqlite'
+
+    # Trim expired and excess rows once every this many writes
+    TRIM_INTERVAL = 100
+
+    def __init__(self, path=RESULT_STORE_PATH, max_entries=RESULT_STORE_SIZE, ttl=RESULT_STORE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # One connection per thread, created after fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    id TEXT PRIMARY KEY,
+                    payload BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_results_accessed ON results (accessed_at)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put(self, key, record):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO results (id, payload, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, encode_record(record), now + self.ttl, now)
+        )
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % self.TRIM_INTERVAL == 0
+        if trim:
+            self.trim()
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute('SELECT payload FROM results WHERE id = ? AND expires_at >= ?', (key, now)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE results SET accessed_at = ? WHERE id = ?', (now, key))
+        return decode_record(row[0])
+
+    def trim(self):
+        """Delete expired rows and the least recently used rows over the limit"""
+        conn = self._connection()
+        removed = conn.execute('DELETE FROM results WHERE expires_at < ?', (time.time(),)).rowcount
+        removed += conn.execute('''
+            DELETE FROM results WHERE id IN (
+                SELECT id FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,)).rowcount
+        with self._lock:
+            self.evictions += removed
+
+    def count(self):
+        """Number of live rows, matching what get() returns"""
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM results WHERE expires_at >= ?', (time.time(),)
+        ).fetchone()[0]
+
+    def stats(self):
+        entries, size = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM results'
+        ).fetchone()
+        return {
+            'backend': self.backend,
+            'entries': entries,
+            'bytes': size,
+            'fileBytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            'maxEntries': self.max_entries,
+            'ttl': self.ttl,
+            'evictions': self.evictions
+        }
+
+
+def create_result_store(backend=RESULT_STORE):
+    """Create the result store selected by RESULT_STORE (memory or sqlite)"""
+    if backend == 'sqlite':
+        return SQLiteResultStore()
+    if backend == 'memory':
+        return MemoryResultStore()
+    raise ValueError(f'Unknown result store backend: {backend}')